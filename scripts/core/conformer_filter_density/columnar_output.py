@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+# 2026-10-19: created by the Cambridge Crystallographic Data Centre
+
+"""Columnar output of per-molecule and per-torsion tables, used by conformer_filter_density.py and filter_poses.py.
+
+Rows are buffered and written in chunks, so a table of any length is written incrementally with bounded memory.
+Tables are written as Parquet files when pyarrow is installed, and otherwise as directories of NumPy .npz files,
+one per chunk, each holding an array for every column. read_table reads either back as a dict of NumPy arrays.
+"""
+
+import glob
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Number of rows buffered before a chunk is written
+CHUNK_ROWS = 10000
+
+FORMATS = ['parquet', 'npz']
+
+# NumPy and Arrow types of the kinds of column, and the value written for a missing value
+COLUMN_KINDS = {
+    'int': (np.int64, 'int64', -1),
+    'float': (np.float64, 'float64', np.nan),
+    'bool': (np.bool_, 'bool_', False),
+    'str': (np.str_, 'string', ''),
+}
+
+
+def default_format():
+    """Parquet if pyarrow is installed, otherwise npz."""
+    return 'parquet' if pyarrow is not None else 'npz'
+
+
+def table_path(prefix, output_format):
+    """Path of a table: a .parquet file, or a directory of .npz chunks."""
+    return prefix + '.parquet' if output_format == 'parquet' else prefix + '_npz'
+
+
+class ColumnarWriter:
+    """
+    Writes rows to a columnar table in chunks.
+
+    columns is a list of (name, kind) pairs, with kind one of 'int', 'float', 'bool' or 'str', and each row is a
+    sequence of values in column order. Missing (None) values are written as -1, NaN, False or '' by kind in npz
+    tables and as nulls in Parquet tables.
+    """
+    def __init__(self, prefix, columns, output_format=None, chunk_rows=CHUNK_ROWS):
+        self.output_format = output_format or default_format()
+        if self.output_format not in FORMATS:
+            raise ValueError('Unknown columnar format %s' % self.output_format)
+        if self.output_format == 'parquet' and pyarrow is None:
+            raise ImportError('pyarrow is needed to write Parquet files; install it, or use the npz format')
+        self.path = table_path(prefix, self.output_format)
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self._buffer = []
+        self._nchunks = 0
+        self._parquet_writer = None
+        if self.output_format == 'npz':
+            os.makedirs(self.path, exist_ok=True)
+            for old_chunk in glob.glob(os.path.join(self.path, 'chunk_*.npz')):
+                os.remove(old_chunk)
+        else:
+            self._schema = pyarrow.schema([(name, getattr(pyarrow, COLUMN_KINDS[kind][1])())
+                                           for name, kind in columns])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk_rows:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """Write the buffered rows as a chunk."""
+        if not self._buffer:
+            return
+        values = list(zip(*self._buffer))
+        if self.output_format == 'parquet':
+            if self._parquet_writer is None:
+                self._parquet_writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+            self._parquet_writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(values, self._schema)],
+                schema=self._schema))
+        else:
+            arrays = {}
+            for (name, kind), column in zip(self.columns, values):
+                dtype, _, missing = COLUMN_KINDS[kind]
+                arrays[name] = np.array([missing if value is None else value for value in column], dtype=dtype)
+            np.savez(os.path.join(self.path, 'chunk_%06d.npz' % self._nchunks), **arrays)
+        self._nchunks += 1
+        self._buffer = []
+
+    def close(self):
+        """Write any buffered rows and finish the table; an empty table is written with its columns only."""
+        if self._nchunks == 0 and not self._buffer:
+            if self.output_format == 'parquet':
+                pyarrow.parquet.write_table(self._schema.empty_table(), self.path)
+            else:
+                np.savez(os.path.join(self.path, 'chunk_%06d.npz' % 0),
+                         **{name: np.array([], dtype=COLUMN_KINDS[kind][0]) for name, kind in self.columns})
+            self._nchunks = 1
+            return
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+
+def read_table(path, columns=None):
+    """
+    Read a table written by ColumnarWriter as a dict of NumPy arrays.
+
+    Args:
+        path: Path of a .parquet file or a directory of .npz chunks
+        columns: Names of the columns to read (default: all)
+
+    Returns:
+        Dict mapping column name to array of its values
+    """
+    if not os.path.isdir(path):
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed to read Parquet files')
+        table = pyarrow.parquet.read_table(path, columns=columns)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+
+    chunks = [np.load(chunk_file) for chunk_file in sorted(glob.glob(os.path.join(path, 'chunk_*.npz')))]
+    if not chunks:
+        return {}
+    names = columns or chunks[0].files
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in names}
@@ -9,10 +9,33 @@
 # 2026-02-03: created by the Cambridge Crystallographic Data Centre
 
 import argparse
+import array
+import contextlib
 import csv
+import multiprocessing
+import tempfile
 
 from ccdc import conformer, io
 
+from torsion_cache import TorsionCache
+
+# Columnar output needs NumPy, which the CSV output does not
+try:
+    from columnar_output import FORMATS, ColumnarWriter
+except ImportError:
+    FORMATS, ColumnarWriter = ['parquet', 'npz'], None
+
+# Number of molecules a worker process analyses per task in parallel mode
+CHUNK_SIZE = 20
+
+# Columns of the unusual torsion CSV file and of the columnar torsion table
+TORSION_COLUMNS = [('MoleculeIndex', 'int'), ('Value', 'float'), ('Zscore', 'float'), ('LocalDensity', 'float'),
+                   ('NumHits', 'int'), ('Atoms', 'str')]
+
+# Columns of the columnar molecule table
+MOLECULE_COLUMNS = [('MoleculeIndex', 'int'), ('Identifier', 'str'), ('NumUnusualTorsions', 'int'),
+                    ('Passed', 'bool')]
+
 
 def parse_args():
     """Parse command line arguments."""
@@ -27,8 +50,24 @@ def parse_args():
                         default='absolute',
                         help='Limit mode: absolute (fixed threshold) or relative '
                              '(threshold based on molecule with fewest unusual torsions). '
-                             'WARNING: Relative mode may behave unexpectedly with conformers '
-                             'from multiple input molecules (default: %(default)s)')
+                             'For conformers from multiple input molecules, use --group-by '
+                             '(default: %(default)s)')
+
+    parser.add_argument('-g', '--group-by',
+                        dest='group_by',
+                        choices=['none', 'identifier', 'smiles'],
+                        default='none',
+                        help='In relative mode, take the fewest unusual torsions separately for each parent '
+                             'molecule, identified by molecule identifier or canonical SMILES '
+                             '(default: %(default)s)')
+
+    parser.add_argument('--identifier-separator',
+                        dest='identifier_separator',
+                        default=None,
+                        metavar='<separator>',
+                        help='With --group-by identifier, identify the parent molecule by the part of the '
+                             'identifier before the last separator, e.g. "_" for identifiers such as LIG1_12 '
+                             '(default: the whole identifier)')
 
     parser.add_argument('-l', '--limit',
                         dest='torsion_limit',
@@ -56,6 +95,20 @@ def parse_args():
                         action='store_true',
                         help='Turn on generalisation for searches')
 
+    parser.add_argument('--torsion-cache',
+                        dest='torsion_cache',
+                        action='store_true',
+                        help='Search the torsion distributions once for each molecule rather than for every '
+                             'conformer, approximating the local densities and z-scores of later conformers from '
+                             'the histograms found for the first')
+
+    parser.add_argument('-n', '--nprocesses',
+                        type=int,
+                        default=1,
+                        metavar='<processes>',
+                        help='Number of processes to analyse the molecules with '
+                             '(default: %(default)s)')
+
     parser.add_argument('--successfn',
                         default='successes.mol',
                         metavar='<file>',
@@ -75,6 +128,20 @@ def parse_args():
                         help='Output CSV file for unusual torsion details '
                              '(default: %(default)s)')
 
+    parser.add_argument('--columnar',
+                        dest='columnar_prefix',
+                        default=None,
+                        metavar='<prefix>',
+                        help='Also write columnar tables of every molecule and of the unusual torsions of every '
+                             'molecule, to <prefix>_molecules and <prefix>_torsions')
+
+    parser.add_argument('--columnar-format',
+                        dest='columnar_format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the columnar tables: Parquet files (requires pyarrow) or directories of '
+                             'NumPy .npz chunks (default: parquet if pyarrow is installed, otherwise npz)')
+
     return parser.parse_args()
 
 
@@ -102,63 +169,237 @@ def create_mogul_engine(local_density_threshold, incl_organometallics, generalis
     return engine
 
 
-def analysis(torsion_limit, input_filename, mode, engine, success_file, failure_file, unusual_torsion_file):
+def build_engine(local_density_threshold, incl_organometallics, generalisation, torsion_cache=False):
+    """Create a geometry analyser engine, wrapped in a TorsionCache if torsion_cache is set."""
+    engine = create_mogul_engine(local_density_threshold, incl_organometallics, generalisation)
+    if torsion_cache:
+        engine = TorsionCache(engine)
+    return engine
+
+
+def standardise(molecule):
+    """Standardise the bonds of a molecule in place before analysis and output."""
+    molecule.standardise_aromatic_bonds()
+    molecule.standardise_delocalised_bonds()
+
+
+def unusual_torsions(engine, molecule):
+    """Analyse a standardised molecule and return its unusual torsions that have enough hits.
+
+    Args:
+        engine: Configured GeometryAnalyser instance
+        molecule: Molecule to analyse
+
+    Returns:
+        List of unusual analysed torsions
+    """
+    geometry_analysed_molecule = engine.analyse_molecule(molecule)
+    return [
+        t for t in geometry_analysed_molecule.analysed_torsions
+        if t.unusual and t.enough_hits
+    ]
+
+
+def parent_key(molecule, group_by, identifier_separator=None):
+    """Key of the parent molecule of a conformer, for relative thresholds.
+
+    Args:
+        molecule: Standardised molecule
+        group_by: 'none', 'identifier' or 'smiles'
+        identifier_separator: Separator before the conformer suffix of identifiers, if any
+
+    Returns:
+        Hashable key, the same for all conformers of a parent molecule
+    """
+    if group_by == 'smiles':
+        return molecule.smiles
+    if group_by == 'identifier':
+        if identifier_separator and identifier_separator in molecule.identifier:
+            return molecule.identifier.rsplit(identifier_separator, 1)[0]
+        return molecule.identifier
+    return None
+
+
+def torsion_rows(idx, torsions):
+    """Rows of the unusual torsion CSV file for a molecule."""
+    return [[idx, torsion.value, torsion.z_score, torsion.local_density, torsion.nhits, ' '.join(torsion.atom_labels)]
+            for torsion in torsions]
+
+
+_worker_engine = None
+_worker_reader = None
+_worker_grouping = ('none', None)
+
+
+def _init_worker(input_filename, engine_args, group_by, identifier_separator):
+    """Create the engine and molecule reader of a worker process."""
+    global _worker_engine, _worker_reader, _worker_grouping
+    # Workers never use the torsion cache: which conformers it approximates would depend on how the molecules are
+    # split into chunks, and the output would then depend on the number of processes
+    _worker_engine = create_mogul_engine(*engine_args)
+    _worker_reader = io.MoleculeReader(input_filename)
+    _worker_grouping = (group_by, identifier_separator)
+
+
+def _analyse_chunk(chunk):
+    """Analyse the molecules with indices in range(start, stop) in a worker process."""
+    start, stop = chunk
+    results = []
+    for idx in range(start, stop):
+        molecule = _worker_reader[idx]
+        standardise(molecule)
+        torsions = unusual_torsions(_worker_engine, molecule)
+        results.append((len(torsions), torsion_rows(idx, torsions), parent_key(molecule, *_worker_grouping)))
+    return results
+
+
+def analysed_molecules(input_filename, engine, group_by='none', identifier_separator=None, nprocesses=1,
+                       engine_args=None, chunk_size=CHUNK_SIZE):
+    """Analyse every molecule in a file, yielding the results of each in input order.
+
+    With more than one process, each worker process builds its own engine from engine_args, without a torsion
+    cache, and reads its chunks of molecules from the file by index, while the molecules yielded are read in order
+    by this process. The results are the same as those of a single process with an engine without a cache.
+
+    Args:
+        input_filename: Path to input molecule file
+        engine: Configured GeometryAnalyser instance, or a TorsionCache wrapping one, for a single process
+        group_by: 'none', 'identifier' or 'smiles' grouping of conformers by parent molecule
+        identifier_separator: Separator before the conformer suffix of identifiers, for grouping by identifier
+        nprocesses: Number of processes to analyse the molecules with
+        engine_args: Arguments of create_mogul_engine for the engines of worker processes
+        chunk_size: Number of molecules a worker process analyses per task
+
+    Yields:
+        Tuples of the standardised molecule, its number of unusual torsions, their CSV rows and its parent key
+    """
+    if nprocesses <= 1:
+        with io.MoleculeReader(input_filename) as mol_reader:
+            for idx, molecule in enumerate(mol_reader):
+                standardise(molecule)
+                torsions = unusual_torsions(engine, molecule)
+                yield (molecule, len(torsions), torsion_rows(idx, torsions),
+                       parent_key(molecule, group_by, identifier_separator))
+        return
+
+    with io.MoleculeReader(input_filename) as mol_reader:
+        nmolecules = len(mol_reader)
+        molecules = iter(mol_reader)
+        chunks = [(start, min(start + chunk_size, nmolecules)) for start in range(0, nmolecules, chunk_size)]
+        with multiprocessing.Pool(nprocesses, _init_worker,
+                                  (input_filename, engine_args, group_by, identifier_separator)) as pool:
+            for chunk_results in pool.imap(_analyse_chunk, chunks):
+                for num_unusual, rows, key in chunk_results:
+                    molecule = next(molecules)
+                    standardise(molecule)
+                    yield molecule, num_unusual, rows, key
+
+
+def analysis(torsion_limit, input_filename, mode, engine, success_file, failure_file, unusual_torsion_file,
+             group_by='none', identifier_separator=None, nprocesses=1, engine_args=None, columnar_prefix=None,
+             columnar_format=None, chunk_size=CHUNK_SIZE):
     """Analyze molecules for unusual torsions and filter based on criteria.
 
+    Molecules are streamed from the input file to the output files, so memory use does not grow with the number
+    of molecules. In absolute mode this takes a single pass. In relative mode, the first pass analyses every
+    molecule, keeping only its count of unusual torsions and spooling their details to a temporary file; the
+    second pass re-reads the molecules and writes them once the threshold is known. With group_by, the relative
+    threshold of each parent molecule comes from the fewest unusual torsions among its own conformers, kept as a
+    running minimum for each parent. With more than one process, the molecules are analysed in chunks by a pool
+    of worker processes, each with its own engine, and the results are written by this process in input order.
+
+    With columnar_prefix, a table of every molecule, whether it passed, and a table of the unusual torsions of
+    every molecule (not only those that failed, as in the CSV file) are also written incrementally; the two
+    tables can be joined on MoleculeIndex.
+
     Args:
         torsion_limit: Maximum number of unusual torsions allowed
         input_filename: Path to input molecule file
         mode: 'absolute' or 'relative' filtering mode
-        engine: Configured GeometryAnalyser instance
+        engine: Configured GeometryAnalyser instance, or a TorsionCache wrapping one
         success_file: Path to output file for passing molecules
         failure_file: Path to output file for failing molecules
         unusual_torsion_file: Path to CSV file for unusual torsion details
+        group_by: 'none', 'identifier' or 'smiles' grouping of conformers by parent molecule in relative mode
+        identifier_separator: Separator before the conformer suffix of identifiers, for grouping by identifier
+        nprocesses: Number of processes to analyse the molecules with
+        engine_args: Arguments of create_mogul_engine for the engines of worker processes, when nprocesses > 1
+        columnar_prefix: Prefix of the columnar molecule and torsion tables, if they are to be written
+        columnar_format: 'parquet' or 'npz' format of the columnar tables (default: parquet if available)
+        chunk_size: Number of molecules a worker process analyses per task, when nprocesses > 1
     """
-    # Analyze all molecules and collect unusual torsion data
-    molecules = []
-    min_unusual_torsions = float('inf')
-
-    with io.MoleculeReader(input_filename) as mol_reader:
-        for molecule in mol_reader:
-            molecule.standardise_aromatic_bonds()
-            molecule.standardise_delocalised_bonds()
-
-            geometry_analysed_molecule = engine.analyse_molecule(molecule)
+    if columnar_prefix and ColumnarWriter is None:
+        raise ImportError('NumPy is needed to write columnar tables')
 
-            molecule.unusual_torsions = [
-                t for t in geometry_analysed_molecule.analysed_torsions
-                if t.unusual and t.enough_hits
-            ]
-            molecule.num_unusual_torsions = len(molecule.unusual_torsions)
-            molecules.append(molecule)
+    results = analysed_molecules(input_filename, engine, group_by, identifier_separator, nprocesses, engine_args,
+                                 chunk_size)
 
-            min_unusual_torsions = min(min_unusual_torsions, molecule.num_unusual_torsions)
-
-    # Write results
     with io.MoleculeWriter(success_file) as passed_writer, \
          io.MoleculeWriter(failure_file) as failed_writer, \
-         open(unusual_torsion_file, 'w', newline='') as csv_file:
+         open(unusual_torsion_file, 'w', newline='') as csv_file, \
+         contextlib.ExitStack() as tables:
 
         csv_writer = csv.writer(csv_file)
-        csv_writer.writerow(['MoleculeIndex', 'Value', 'Zscore', 'LocalDensity', 'NumHits', 'Atoms'])
-
-        for idx, molecule in enumerate(molecules):
-            threshold = torsion_limit if mode == 'absolute' else min_unusual_torsions + torsion_limit
-            failed = molecule.num_unusual_torsions > threshold
-
-            if failed:
-                failed_writer.write(molecule)
-                for torsion in molecule.unusual_torsions:
-                    csv_writer.writerow([
-                        idx,
-                        torsion.value,
-                        torsion.z_score,
-                        torsion.local_density,
-                        torsion.nhits,
-                        ' '.join(torsion.atom_labels)
-                    ])
-            else:
-                passed_writer.write(molecule)
+        csv_writer.writerow([name for name, _ in TORSION_COLUMNS])
+
+        molecule_table = torsion_table = None
+        if columnar_prefix:
+            molecule_table = tables.enter_context(
+                ColumnarWriter(columnar_prefix + '_molecules', MOLECULE_COLUMNS, columnar_format))
+            torsion_table = tables.enter_context(
+                ColumnarWriter(columnar_prefix + '_torsions', TORSION_COLUMNS, columnar_format))
+
+        if mode == 'absolute':
+            for idx, (molecule, num_unusual, rows, _) in enumerate(results):
+                passed = num_unusual <= torsion_limit
+                if passed:
+                    passed_writer.write(molecule)
+                else:
+                    failed_writer.write(molecule)
+                    csv_writer.writerows(rows)
+                if columnar_prefix:
+                    molecule_table.write([idx, molecule.identifier, num_unusual, passed])
+                    torsion_table.write_rows(rows)
+            return
+
+        # First pass: count the unusual torsions of each molecule, and the fewest of each parent molecule
+        num_unusual_torsions = array.array('l')
+        molecule_groups = array.array('l')
+        group_indices = {}
+        group_minima = []
+        with tempfile.TemporaryFile('w+', newline='') as spool_file:
+            spool_writer = csv.writer(spool_file)
+            for _, num_unusual, rows, key in results:
+                num_unusual_torsions.append(num_unusual)
+                spool_writer.writerows(rows)
+                if columnar_prefix:
+                    torsion_table.write_rows(rows)
+
+                group = group_indices.setdefault(key, len(group_indices))
+                molecule_groups.append(group)
+                if group == len(group_minima):
+                    group_minima.append(num_unusual)
+                else:
+                    group_minima[group] = min(group_minima[group], num_unusual)
+
+            def failed(idx):
+                return num_unusual_torsions[idx] > group_minima[molecule_groups[idx]] + torsion_limit
+
+            # Second pass: write the molecules, then the unusual torsions of those that failed
+            with io.MoleculeReader(input_filename) as mol_reader:
+                for idx, molecule in enumerate(mol_reader):
+                    standardise(molecule)
+                    if failed(idx):
+                        failed_writer.write(molecule)
+                    else:
+                        passed_writer.write(molecule)
+                    if columnar_prefix:
+                        molecule_table.write([idx, molecule.identifier, num_unusual_torsions[idx], not failed(idx)])
+
+            spool_file.seek(0)
+            for row in csv.reader(spool_file):
+                if failed(int(row[0])):
+                    csv_writer.writerow(row)
 
 
 def run():
@@ -168,11 +409,24 @@ def run():
     if args.torsion_limit < 0:
         raise ValueError('Torsion limit must be >= 0')
 
-    engine = create_mogul_engine(
+    if args.nprocesses < 1:
+        raise ValueError('Number of processes must be >= 1')
+
+    if args.columnar_prefix and ColumnarWriter is None:
+        raise ImportError('NumPy is needed to write columnar tables')
+
+    engine_args = (
         args.local_density_threshold,
         args.incl_organometallics,
-        args.generalisation
+        args.generalisation,
     )
+    # Worker processes build their own engines, without the torsion cache, in parallel mode
+    if args.nprocesses == 1:
+        engine = build_engine(*engine_args, torsion_cache=args.torsion_cache)
+    else:
+        engine = None
+        if args.torsion_cache:
+            print('Warning: --torsion-cache is ignored with more than one process')
 
     analysis(
         args.torsion_limit,
@@ -182,6 +436,12 @@ def run():
         args.successfn,
         args.failurefn,
         args.unusualtorsionsfn,
+        args.group_by,
+        args.identifier_separator,
+        args.nprocesses,
+        engine_args,
+        args.columnar_prefix,
+        args.columnar_format,
     )
 
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import columnar_output
+from columnar_output import ColumnarWriter, read_table, table_path
+
+COLUMNS = [('index', 'int'), ('value', 'float'), ('unusual', 'bool'), ('atoms', 'str')]
+
+ROWS = [[i, i * 1.5, i % 3 == 0, 'C%d C%d C%d C%d' % (i, i + 1, i + 2, i + 3)] for i in range(25)]
+
+
+def formats():
+    """The formats that can be written here: npz always, Parquet only with pyarrow."""
+    return ['npz', 'parquet'] if columnar_output.pyarrow is not None else ['npz']
+
+
+class TestColumnarOutput(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.directory, 'table')
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def test_round_trip_in_chunks(self):
+
+        for output_format in formats():
+            with ColumnarWriter(self.prefix, COLUMNS, output_format, chunk_rows=7) as writer:
+                writer.write_rows(ROWS)
+
+            table = read_table(table_path(self.prefix, output_format))
+
+            self.assertEqual(list(table), [name for name, _ in COLUMNS])
+            for i, (name, _) in enumerate(COLUMNS):
+                self.assertEqual(list(table[name]), [row[i] for row in ROWS])
+
+    def test_npz_chunks(self):
+
+        with ColumnarWriter(self.prefix, COLUMNS, 'npz', chunk_rows=7) as writer:
+            writer.write_rows(ROWS)
+
+        self.assertEqual(len(os.listdir(table_path(self.prefix, 'npz'))), 4)
+
+    def test_missing_values(self):
+
+        for output_format in formats():
+            with ColumnarWriter(self.prefix, COLUMNS, output_format) as writer:
+                writer.write([None, None, None, None])
+
+            table = read_table(table_path(self.prefix, output_format))
+
+            self.assertTrue(np.isnan(table['value'][0]))
+
+    def test_empty_table(self):
+
+        for output_format in formats():
+            with ColumnarWriter(self.prefix, COLUMNS, output_format):
+                pass
+
+            table = read_table(table_path(self.prefix, output_format))
+
+            self.assertEqual(sorted(table), sorted(name for name, _ in COLUMNS))
+            self.assertEqual(len(table['index']), 0)
+
+    def test_rewrite_replaces_old_chunks(self):
+
+        with ColumnarWriter(self.prefix, COLUMNS, 'npz', chunk_rows=5) as writer:
+            writer.write_rows(ROWS)
+        with ColumnarWriter(self.prefix, COLUMNS, 'npz', chunk_rows=5) as writer:
+            writer.write_rows(ROWS[:3])
+
+        self.assertEqual(list(read_table(table_path(self.prefix, 'npz'))['index']), [0, 1, 2])
+
+    def test_read_selected_columns(self):
+
+        for output_format in formats():
+            with ColumnarWriter(self.prefix, COLUMNS, output_format) as writer:
+                writer.write_rows(ROWS)
+
+            table = read_table(table_path(self.prefix, output_format), columns=['value'])
+
+            self.assertEqual(list(table), ['value'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from conformer_filter_density import analysis, create_mogul_engine
+
+INPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'conformers.sdf')
+
+ENGINE_ARGS = (10.0, False, False)
+
+
+class TestParallelAnalysis(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def outputs(self, name, mode, nprocesses, group_by='none'):
+        """Run the analysis and return the contents of its successes, failures and CSV files."""
+        filenames = [os.path.join(self.directory, '%s_%s' % (name, suffix))
+                     for suffix in ('successes.sdf', 'failures.sdf', 'unusual_torsions.csv')]
+        engine = create_mogul_engine(*ENGINE_ARGS) if nprocesses == 1 else None
+        analysis(0, INPUT_FILE, mode, engine, *filenames, group_by=group_by, identifier_separator='_',
+                 nprocesses=nprocesses, engine_args=ENGINE_ARGS, chunk_size=2)
+        contents = []
+        for filename in filenames:
+            with open(filename) as output_file:
+                contents.append(output_file.read())
+        return contents
+
+    def test_absolute_mode_matches_serial(self):
+
+        self.assertEqual(self.outputs('serial', 'absolute', 1), self.outputs('parallel', 'absolute', 3))
+
+    def test_relative_mode_matches_serial(self):
+
+        self.assertEqual(self.outputs('serial', 'relative', 1, 'identifier'),
+                         self.outputs('parallel', 'relative', 3, 'identifier'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import math
+import unittest
+from types import SimpleNamespace
+
+from torsion_cache import CachedTorsion, TorsionCache, torsion_angle
+
+
+def make_atom(index, label, coordinates):
+    return SimpleNamespace(index=index, label=label, atomic_symbol='C', formal_charge=0, coordinates=coordinates)
+
+
+def make_molecule(coordinates):
+    atoms = [make_atom(i, 'C%d' % (i + 1), xyz) for i, xyz in enumerate(coordinates)]
+    bonds = [SimpleNamespace(atoms=(atoms[i], atoms[i + 1]), bond_type='Single') for i in range(len(atoms) - 1)]
+    return SimpleNamespace(atoms=atoms, bonds=bonds)
+
+
+def butane(torsion):
+    """Four atoms with the given torsion angle about the middle bond, in degrees."""
+    radians = math.radians(torsion)
+    return make_molecule([(1.0, 0.0, 0.0), (0.0, 0.0, 0.0), (0.0, 1.0, 0.0),
+                          (math.cos(radians), 1.0, -math.sin(radians))])
+
+
+class CountingEngine:
+    """Stands in for a GeometryAnalyser, analysing one torsion with a fixed histogram."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.searches = 0
+        self.settings = SimpleNamespace(torsion=SimpleNamespace(local_density_threshold=10.0),
+                                        generalisation=False, organometallic_filter='organics_only')
+
+    def analyse_molecule(self, molecule):
+        self.searches += 1
+        return SimpleNamespace(analysed_torsions=[SimpleNamespace(
+            atom_labels=['C1', 'C2', 'C3', 'C4'], histogram=lambda: list(self.histogram), enough_hits=True,
+            nhits=sum(self.histogram))])
+
+
+class TestCachedTorsion(unittest.TestCase):
+
+    def torsion(self, value, histogram, enough_hits=True):
+        return CachedTorsion(['C1', 'C2', 'C3', 'C4'], value, histogram, enough_hits, sum(histogram), 10.0)
+
+    def test_hits_at_ends_are_counted_once(self):
+
+        first_bin = [100] + [0] * 17
+        last_bin = [0] * 17 + [100]
+
+        self.assertAlmostEqual(self.torsion(0.0, first_bin).local_density, 100.0)
+        self.assertAlmostEqual(self.torsion(2.0, first_bin).local_density, 100.0)
+        self.assertAlmostEqual(self.torsion(-2.0, first_bin).local_density, 100.0)
+        self.assertAlmostEqual(self.torsion(180.0, last_bin).local_density, 100.0)
+        self.assertAlmostEqual(self.torsion(15.0, first_bin).local_density, 50.0)
+
+    def test_local_density_never_exceeds_100(self):
+
+        for histogram in ([100] + [0] * 17, [0] * 17 + [100], [5] * 18, [1, 2, 3] * 6):
+            for value in range(-180, 181, 5):
+                self.assertLessEqual(self.torsion(value, histogram).local_density, 100.0 + 1e-9)
+
+    def test_uniform_distribution(self):
+
+        torsion = self.torsion(90.0, [10] * 18)
+
+        self.assertAlmostEqual(torsion.local_density, 100.0 * 20.0 / 180.0)
+        self.assertAlmostEqual(torsion.z_score, 0.0)
+
+    def test_planar_torsion_can_be_unusual(self):
+
+        self.assertTrue(self.torsion(0.0, [0] * 17 + [100]).unusual)
+        self.assertFalse(self.torsion(0.0, [100] + [0] * 17).unusual)
+
+    def test_no_hits_is_not_unusual(self):
+
+        for torsion in (self.torsion(60.0, [0] * 18), self.torsion(60.0, [0] * 17 + [100], enough_hits=False)):
+            self.assertFalse(torsion.enough_hits)
+            self.assertFalse(torsion.unusual)
+            self.assertEqual(torsion.local_density, 0.0)
+            self.assertEqual(torsion.z_score, 0.0)
+
+
+class TestTorsionAngle(unittest.TestCase):
+
+    def test_sign_and_magnitude(self):
+
+        for value in (0.0, 60.0, -60.0, 120.0, -150.0, 180.0):
+            atoms = butane(value).atoms
+            self.assertAlmostEqual(abs(torsion_angle(*atoms)), abs(value), places=6)
+            if 0.0 < abs(value) < 180.0:
+                self.assertEqual(torsion_angle(*atoms) > 0, value > 0)
+
+
+class TestTorsionCache(unittest.TestCase):
+
+    def test_searches_once_per_molecule(self):
+
+        engine = CountingEngine([0] * 6 + [100] + [0] * 11)
+        cache = TorsionCache(engine)
+
+        cache.analyse_molecule(butane(60.0))
+        analysis = cache.analyse_molecule(butane(-65.0))
+
+        self.assertEqual(engine.searches, 1)
+        torsion, = analysis.analysed_torsions
+        self.assertAlmostEqual(torsion.value, -65.0, places=6)
+        self.assertAlmostEqual(torsion.local_density, 100.0)
+        self.assertFalse(torsion.unusual)
+
+    def test_changed_settings_search_again(self):
+
+        engine = CountingEngine([10] * 18)
+        cache = TorsionCache(engine)
+
+        cache.analyse_molecule(butane(60.0))
+        engine.settings.generalisation = True
+        cache.analyse_molecule(butane(60.0))
+
+        self.assertEqual(engine.searches, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+# 2026-10-19: created by the Cambridge Crystallographic Data Centre
+
+"""Torsion-level cache of GeometryAnalyser searches, used by conformer_filter_density.py and filter_poses.py.
+
+The distribution found for a torsion depends only on the torsion's fragment, and the fragment is fixed by the
+molecule's atoms and connectivity, so every conformer or pose of a molecule has the same distributions. The
+first conformation of each molecule is analysed as normal and the histogram, enough_hits and number of hits of
+each of its torsions are kept; later conformations only have their torsion values, local densities and
+z-scores computed from the kept histograms, without searching again.
+
+Since the cached local densities and z-scores are approximations, calculated from the binned histograms rather
+than from the hits themselves, they can differ slightly from those of a search, and a torsion close to the local
+density threshold can be classified differently. The cache is therefore only used when asked for.
+"""
+
+import collections
+import math
+
+# Number of molecules whose torsion distributions are kept
+CACHE_SIZE = 1024
+
+# Half width of the window around a torsion value that counts towards its local density, in degrees
+LOCAL_DENSITY_WINDOW = 10.0
+
+
+def molecule_key(molecule):
+    """Key identifying conformations of the same molecule: its atoms and their connectivity, in atom order."""
+    atoms = tuple((atom.atomic_symbol, atom.formal_charge, atom.label) for atom in molecule.atoms)
+    bonds = tuple(sorted((min(bond.atoms[0].index, bond.atoms[1].index),
+                          max(bond.atoms[0].index, bond.atoms[1].index),
+                          str(bond.bond_type)) for bond in molecule.bonds))
+    return atoms, bonds
+
+
+def torsion_angle(a, b, c, d):
+    """Signed torsion angle, in degrees, of four atoms."""
+    def sub(u, v):
+        return [u[i] - v[i] for i in range(3)]
+
+    def cross(u, v):
+        return [u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]]
+
+    def dot(u, v):
+        return sum(u[i] * v[i] for i in range(3))
+
+    b1 = sub(b.coordinates, a.coordinates)
+    b2 = sub(c.coordinates, b.coordinates)
+    b3 = sub(d.coordinates, c.coordinates)
+    n2 = cross(b2, b3)
+    return math.degrees(math.atan2(math.sqrt(dot(b2, b2)) * dot(b1, n2), dot(cross(b1, b2), n2)))
+
+
+class CachedTorsion:
+    """
+    An analysed torsion of a conformation, with its distribution taken from the cache.
+
+    The local density and z-score are approximations to those of a search: hits are taken to be spread evenly
+    within each bin of the histogram, which covers absolute torsion values from 0 to 180 degrees, and the z-score
+    is taken against the mean and standard deviation of the absolute values.
+    """
+    def __init__(self, atom_labels, value, histogram, enough_hits, nhits, local_density_threshold):
+        self.atom_labels = atom_labels
+        self.value = value
+        self.nhits = nhits
+        self._histogram = histogram
+        # As for a search, a torsion without enough hits is never unusual
+        self.enough_hits = enough_hits and sum(histogram) > 0
+        self.local_density = self._local_density(abs(value)) if self.enough_hits else 0.0
+        self.z_score = self._z_score(abs(value)) if self.enough_hits else 0.0
+        self.unusual = self.enough_hits and self.local_density < local_density_threshold
+
+    def histogram(self):
+        return list(self._histogram)
+
+    def _bins(self):
+        # The histogram bins are taken to span 0 to 180 degrees evenly
+        width = 180.0 / len(self._histogram)
+        return [(i * width, (i + 1) * width, count) for i, count in enumerate(self._histogram)]
+
+    def _local_density(self, value):
+        """Percentage of hits within the window around the value, with the window clamped to 0 to 180 degrees."""
+        start = max(0.0, value - LOCAL_DENSITY_WINDOW)
+        stop = min(180.0, value + LOCAL_DENSITY_WINDOW)
+        count = 0.0
+        for low, high, n in self._bins():
+            # Hits are taken to be spread evenly across each bin
+            overlap = min(high, stop) - max(low, start)
+            if overlap > 0:
+                count += n * overlap / (high - low)
+        return 100.0 * count / sum(self._histogram)
+
+    def _z_score(self, value):
+        bins = self._bins()
+        total = sum(self._histogram)
+        mean = sum(n * (low + high) / 2 for low, high, n in bins) / total
+        variance = sum(n * ((low + high) / 2 - mean) ** 2 for low, high, n in bins) / total
+        return (value - mean) / math.sqrt(variance) if variance > 0 else 0.0
+
+
+class CachedAnalysis:
+    """Analysis of a conformation made from cached torsion distributions."""
+    def __init__(self, analysed_torsions):
+        self.analysed_torsions = analysed_torsions
+
+
+class TorsionCache:
+    """
+    Wraps a GeometryAnalyser, reusing the torsion distributions of a molecule for all its conformations.
+
+    Only torsions are cached, so the analyser should be set to analyse torsions only. Molecules whose torsions
+    cannot be matched to their atoms by label are always analysed in full.
+    """
+    def __init__(self, engine, cache_size=CACHE_SIZE):
+        self.engine = engine
+        self.cache_size = cache_size
+        self._distributions = collections.OrderedDict()
+
+    @property
+    def settings(self):
+        return self.engine.settings
+
+    def _settings_key(self):
+        settings = self.engine.settings
+        return (settings.torsion.local_density_threshold, settings.generalisation,
+                settings.organometallic_filter)
+
+    def analyse_molecule(self, molecule):
+        key = (self._settings_key(), molecule_key(molecule))
+        distributions = self._distributions.get(key)
+        if distributions is None:
+            analysed_molecule = self.engine.analyse_molecule(molecule)
+            distributions = self._torsion_distributions(analysed_molecule, molecule)
+            if distributions is not None:
+                self._distributions[key] = distributions
+                if len(self._distributions) > self.cache_size:
+                    self._distributions.popitem(last=False)
+            return analysed_molecule
+
+        self._distributions.move_to_end(key)
+        atoms = molecule.atoms
+        threshold = self.engine.settings.torsion.local_density_threshold
+        return CachedAnalysis([
+            CachedTorsion(atom_labels, torsion_angle(*[atoms[i] for i in indices]), histogram, enough_hits, nhits,
+                          threshold)
+            for atom_labels, indices, histogram, enough_hits, nhits in distributions])
+
+    @staticmethod
+    def _torsion_distributions(analysed_molecule, molecule):
+        """The atoms and distribution of each analysed torsion, or None if atoms cannot be identified by label."""
+        indices = {}
+        for atom in molecule.atoms:
+            if atom.label in indices:
+                return None
+            indices[atom.label] = atom.index
+
+        distributions = []
+        for tor in analysed_molecule.analysed_torsions:
+            atom_labels = list(tor.atom_labels)
+            if any(label not in indices for label in atom_labels):
+                return None
+            distributions.append((atom_labels, [indices[label] for label in atom_labels], list(tor.histogram()),
+                                  tor.enough_hits, tor.nhits))
+        return distributions
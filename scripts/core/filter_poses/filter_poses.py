@@ -9,11 +9,56 @@
 # 2025-02-03: created by the Cambridge Crystallographic Data Centre
 
 import argparse
+import collections
+import contextlib
 import copy
 import csv
 import math
+import multiprocessing
+import os
+import sys
 
 from ccdc import conformer, io
+from ccdc.descriptors import MolecularDescriptors
+
+# The torsion cache is shared with the conformer_filter_density script; without it, every pose is searched
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'conformer_filter_density'))
+try:
+    from torsion_cache import TorsionCache, molecule_key
+except ImportError:
+    TorsionCache = molecule_key = None
+try:
+    from columnar_output import FORMATS, ColumnarWriter
+except ImportError:
+    FORMATS, ColumnarWriter = ['parquet', 'npz'], None
+
+# Number of poses a worker process scores per task in parallel mode
+CHUNK_SIZE = 20
+
+# Number of unique ligands whose most likely conformer is kept for reuse by later poses
+LIGAND_CACHE_SIZE = 256
+
+# Columns of the pose table, in the order of the data of each pose
+POSE_COLUMNS = [
+    ('identifier', 'str'),
+    ('number of unusual torsions', 'int'),
+    ('average local density', 'float'),
+    ('average unusual local density', 'float'),
+    ('number of torsions with no data', 'int'),
+    ('normalised probability score', 'float'),
+    ('probability score', 'float'),
+    ('RMSD to input conformation', 'float'),
+]
+
+# Columns of the torsion table, with a row for each analysed torsion of each pose
+TORSION_COLUMNS = [
+    ('pose index', 'int'),
+    ('atoms', 'str'),
+    ('value', 'float'),
+    ('local density', 'float'),
+    ('histogram size', 'int'),
+    ('unusual', 'bool'),
+]
 
 
 def parse_args():
@@ -29,6 +74,36 @@ def parse_args():
                         action='store_true',
                         help='Write a csv file for all the analysed conformers.')
 
+    parser.add_argument('-n', '--nprocesses',
+                        type=int,
+                        default=1,
+                        help='Number of processes to score the poses with (default: %(default)s).')
+
+    parser.add_argument('--no-deduplicate',
+                        dest='deduplicate',
+                        action='store_false',
+                        help='Generate conformers for every pose, rather than once for each unique ligand.')
+
+    parser.add_argument('--torsion-cache',
+                        dest='torsion_cache',
+                        action='store_true',
+                        help='Search the torsion distributions once for each unique ligand rather than for every '
+                             'pose, approximating the local densities of later poses from the histograms found '
+                             'for the first.')
+
+    parser.add_argument('--write-columnar',
+                        dest='write_columnar',
+                        action='store_true',
+                        help='Write columnar tables of all the analysed conformers and of each of their torsions, '
+                             'filtered_poses_analysis and filtered_poses_torsions.')
+
+    parser.add_argument('--columnar-format',
+                        dest='columnar_format',
+                        choices=FORMATS,
+                        default=None,
+                        help='Format of the columnar tables: Parquet files (requires pyarrow) or directories of '
+                             'NumPy .npz chunks (default: parquet if pyarrow is installed, otherwise npz).')
+
     return parser.parse_args()
 
 
@@ -36,12 +111,22 @@ class ProbabilityScorer:
     """
     Use the ConformerGenerator and GeometryAnalyser to score conformers based on their conformational
     probabilities and unusual torsions.
+
+    Poses of the same ligand have the same conformer distribution, so with deduplicate, conformers are generated
+    once for each unique ligand, and later poses of it only have their RMSD to the most likely conformer computed.
+    Likewise, with torsion_cache, the torsion distributions are searched once for each unique ligand, and the
+    local densities of later poses are approximated from them (see torsion_cache.py).
     """
     def __init__(self, user_conformer_generator_settings=None, skip_minimisation=True,
-                 user_mogul_analysis_settings=None):
+                 user_mogul_analysis_settings=None, deduplicate=True, torsion_cache=False):
 
         self._generator = self._create_conformer_generator(user_conformer_generator_settings, skip_minimisation)
         self._mogul_analysis_engine = self._create_analyser(user_mogul_analysis_settings)
+        if torsion_cache and TorsionCache is not None:
+            self._mogul_analysis_engine = TorsionCache(self._mogul_analysis_engine)
+        # Poses of the same ligand are recognised with the key of torsion_cache.py
+        self._deduplicate = deduplicate and molecule_key is not None
+        self._ligand_cache = collections.OrderedDict()
 
     def _create_analyser(self, user_mogul_analyser_settings):
         """Create a GeometryAnalyser engine to analyse the conformers."""
@@ -82,23 +167,49 @@ class ProbabilityScorer:
             return sum(all_local_densities) / len(all_local_densities)
         return 100.0
 
+    def _most_likely_conformer(self, molecule):
+        """
+        Return the most likely conformer of the molecule's ligand, or None, and its RMSD to the molecule.
+
+        The RMSD is computed the same way whether the conformers were generated for this pose or for an earlier
+        pose of the ligand, so that deduplication does not change it.
+        """
+        key = molecule_key(molecule) if self._deduplicate else None
+        if key in self._ligand_cache:
+            self._ligand_cache.move_to_end(key)
+            best = self._ligand_cache[key]
+        else:
+            conformers = self._generator.generate(molecule)
+            # First conformer is the most likely.
+            best = conformers[0] if conformers else None
+            if key is not None:
+                self._ligand_cache[key] = best
+                if len(self._ligand_cache) > LIGAND_CACHE_SIZE:
+                    self._ligand_cache.popitem(last=False)
+
+        if best is None:
+            return None, None
+        return best, MolecularDescriptors.rmsd(molecule, best.molecule, overlay=True)
+
+    def clear_ligand_cache(self):
+        """Forget the most likely conformers kept for earlier poses."""
+        self._ligand_cache.clear()
+
     def probability_analysis(self, molecule, bad_normalised_score=1.0, bad_probability_score=0.0,
                              bad_rmsd_score=9999.9):
 
         # Approximation excluding rings:
         is_rigid = sum(bond.is_rotatable for bond in molecule.bonds) == 0
 
-        conformers = self._generator.generate(molecule)
+        best, rmsd = self._most_likely_conformer(molecule)
 
         normalised_score = None
-        rmsd = None
         ln_probability = None
 
-        if conformers:
-            # First conformer is the most likely, so return its score.
-            normalised_score = conformers[0].normalised_score
-            rmsd = conformers[0].rmsd()
-            ln_probability = conformers[0].probability
+        if best is not None:
+            # Return the score of the most likely conformer.
+            normalised_score = best.normalised_score
+            ln_probability = best.probability
 
             if is_rigid:
                 if ln_probability is None:
@@ -118,7 +229,7 @@ class ProbabilityScorer:
 
         return normalised_score, probability, rmsd
 
-    def unusual_torsions_analysis(self, molecule, max_hist_size=15):
+    def unusual_torsions_analysis(self, molecule, max_hist_size=15, torsion_rows=None):
         checked_mol = self._mogul_analysis_engine.analyse_molecule(molecule)
         unusual_count = 0
         local_densities = []
@@ -126,6 +237,9 @@ class ProbabilityScorer:
         no_data_torsions = 0
         for tor in checked_mol.analysed_torsions:
             hist_size = sum(tor.histogram())
+            if torsion_rows is not None:
+                torsion_rows.append([' '.join(tor.atom_labels), tor.value, tor.local_density, hist_size,
+                                     bool(tor.unusual)])
             if hist_size > max_hist_size:
                 local_densities.append(tor.local_density)
 
@@ -142,12 +256,16 @@ class ProbabilityScorer:
         return unusual_count, self._combined_local_density(local_densities), self._combined_local_density(
             unusual_local_densities), no_data_torsions
 
-    def process_molecule(self, molecule):
+    def process_molecule(self, molecule, torsion_rows=None):
+        """
+        Score a pose, returning its data. With torsion_rows, a list, the atoms, value, local density, histogram
+        size and unusual flag of each analysed torsion are appended to it.
+        """
         molecule.remove_unknown_atoms()
         molecule.assign_bond_types()
 
         unusual_count, avg_local_density, avg_unusual_local_density, no_data_torsions = self.unusual_torsions_analysis(
-            molecule)
+            molecule, torsion_rows=torsion_rows)
         normalised_score, probability, rmsd = self.probability_analysis(molecule)
 
         return {
@@ -162,27 +280,137 @@ class ProbabilityScorer:
         }
 
 
+_worker_scorer = None
+_worker_reader = None
+_worker_torsion_details = False
+
+
+def _init_worker(conformer_file, scorer_kwargs, torsion_details):
+    """Create the scorer and molecule reader of a worker process."""
+    global _worker_scorer, _worker_reader, _worker_torsion_details
+    # Workers never use the torsion cache: which poses it approximates would depend on how the poses are split into
+    # chunks, and the scores would then depend on the number of processes
+    _worker_scorer = ProbabilityScorer(**dict(scorer_kwargs, torsion_cache=False))
+    _worker_reader = io.MoleculeReader(conformer_file)
+    _worker_torsion_details = torsion_details
+
+
+def _score_pose(scorer, molecule, torsion_details):
+    """The data of a pose and, with torsion_details, the rows of its torsions (otherwise None)."""
+    torsion_rows = [] if torsion_details else None
+    return scorer.process_molecule(molecule, torsion_rows), torsion_rows
+
+
+def _score_chunk(chunk):
+    """Score the groups of poses with the given indices in a worker process, returning each index with its data."""
+    results = []
+    for group in chunk:
+        # A group shares the conformers of its first pose, and no others, as it would when scored in one process
+        _worker_scorer.clear_ligand_cache()
+        results.extend((i, _score_pose(_worker_scorer, _worker_reader[i], _worker_torsion_details)) for i in group)
+    return results
+
+
+def ligand_groups(conformer_file, deduplicate=True):
+    """
+    The indices of the poses in a file, in groups that a single ProbabilityScorer would score with the conformers
+    generated for the first pose of each group: the poses of each ligand until it would be dropped from the ligand
+    cache, or each pose on its own without deduplication. Groups are in the order of their first poses.
+    """
+    with io.MoleculeReader(conformer_file) as reader:
+        if not deduplicate or molecule_key is None:
+            return [[i] for i in range(len(reader))]
+
+        groups = []
+        ligands = collections.OrderedDict()
+        for i, molecule in enumerate(reader):
+            molecule.remove_unknown_atoms()
+            molecule.assign_bond_types()
+            key = molecule_key(molecule)
+            if key in ligands:
+                ligands.move_to_end(key)
+                ligands[key].append(i)
+            else:
+                ligands[key] = [i]
+                groups.append(ligands[key])
+                if len(ligands) > LIGAND_CACHE_SIZE:
+                    ligands.popitem(last=False)
+    return groups
+
+
+def score_poses(conformer_file, nprocesses=1, chunk_size=CHUNK_SIZE, torsion_details=False, **scorer_kwargs):
+    """
+    Score every pose in a file, yielding the data of each in input order, paired with the rows of its torsions
+    if torsion_details is set (otherwise None).
+
+    With more than one process, each worker process builds its own scorer with the same settings, except that the
+    torsion cache is not used, and reads its chunks of poses from the file by index. Poses that share conformers
+    are kept in the same chunk, so the results are the same as with one process; a chunk holds whole groups of
+    poses, and so may have more than chunk_size poses.
+    """
+    if nprocesses <= 1:
+        p = ProbabilityScorer(**scorer_kwargs)
+        with io.MoleculeReader(conformer_file) as reader:
+            for molecule in reader:
+                yield _score_pose(p, molecule, torsion_details)
+        return
+
+    chunks = []
+    chunk_poses = 0
+    for group in ligand_groups(conformer_file, scorer_kwargs.get('deduplicate', True)):
+        if not chunks or chunk_poses >= chunk_size:
+            chunks.append([])
+            chunk_poses = 0
+        chunks[-1].append(group)
+        chunk_poses += len(group)
+
+    # Chunks are in the order of their first poses, so only poses of interleaved ligands wait to be yielded
+    pending = {}
+    next_index = 0
+    with multiprocessing.Pool(nprocesses, _init_worker, (conformer_file, scorer_kwargs, torsion_details)) as pool:
+        for chunk_data in pool.imap(_score_chunk, chunks):
+            pending.update(chunk_data)
+            while next_index in pending:
+                yield pending.pop(next_index)
+                next_index += 1
+
+
 def run():
     args = parse_args()
 
-    p = ProbabilityScorer()
+    if args.write_columnar and ColumnarWriter is None:
+        print('Error! columnar_output.py from the Conformer Filter Density script, and NumPy, are needed to write '
+              'columnar tables')
+        sys.exit(1)
 
-    all_data = []
+    if args.nprocesses > 1 and args.torsion_cache:
+        print('Warning: --torsion-cache is ignored with more than one process')
 
-    with io.MoleculeReader(args.conformer_file) as reader:
-        for i, molecule in enumerate(reader):
-            data = p.process_molecule(molecule)
+    # Results are written as each pose is scored, so nothing is kept for the end
+    with contextlib.ExitStack() as outputs:
+        dict_writer = pose_table = torsion_table = None
+        if args.write_csv:
+            output_file = outputs.enter_context(open('filtered_poses_analysis.csv', 'w', newline=''))
+            dict_writer = csv.DictWriter(output_file, [name for name, _ in POSE_COLUMNS])
+            dict_writer.writeheader()
+        if args.write_columnar:
+            pose_table = outputs.enter_context(
+                ColumnarWriter('filtered_poses_analysis', POSE_COLUMNS, args.columnar_format))
+            torsion_table = outputs.enter_context(
+                ColumnarWriter('filtered_poses_torsions', TORSION_COLUMNS, args.columnar_format))
+
+        for i, (data, torsion_rows) in enumerate(score_poses(args.conformer_file, args.nprocesses,
+                                                             torsion_details=args.write_columnar,
+                                                             deduplicate=args.deduplicate,
+                                                             torsion_cache=args.torsion_cache)):
             if i == 0:
                 print(", ".join(data.keys()))
             print(", ".join(str(value) for value in data.values()))
-            all_data.append(data)
-
-    if args.write_csv:
-        keys = all_data[0].keys()
-        with open('filtered_poses_analysis.csv', 'w', newline='') as output_file:
-            dict_writer = csv.DictWriter(output_file, keys)
-            dict_writer.writeheader()
-            dict_writer.writerows(all_data)
+            if dict_writer is not None:
+                dict_writer.writerow(data)
+            if pose_table is not None:
+                pose_table.write([data[name] for name, _ in POSE_COLUMNS])
+                torsion_table.write_rows([i] + row for row in torsion_rows)
 
 
 if __name__ == "__main__":
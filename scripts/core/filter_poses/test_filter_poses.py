@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import os
+import unittest
+
+from filter_poses import ligand_groups, score_poses
+
+# The test poses are shared with the conformer_filter_density tests
+INPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'conformer_filter_density',
+                          'test_data', 'conformers.sdf')
+
+
+class TestParallelScoring(unittest.TestCase):
+
+    def test_parallel_matches_serial(self):
+
+        serial = list(score_poses(INPUT_FILE, torsion_details=True))
+        # The torsion cache is asked for, but worker processes must not use it
+        parallel = list(score_poses(INPUT_FILE, 3, chunk_size=2, torsion_details=True, torsion_cache=True))
+
+        self.assertEqual(serial, parallel)
+
+    def test_parallel_matches_serial_without_deduplication(self):
+
+        serial = list(score_poses(INPUT_FILE, deduplicate=False, torsion_details=True))
+        parallel = list(score_poses(INPUT_FILE, 3, chunk_size=2, deduplicate=False, torsion_details=True))
+
+        self.assertEqual(serial, parallel)
+
+    def test_ligand_groups(self):
+
+        # Later poses of a ligand are grouped with its first pose, and without deduplication every pose is alone
+        groups = ligand_groups(INPUT_FILE)
+
+        self.assertEqual(sorted(i for group in groups for i in group), list(range(10)))
+        self.assertEqual([group[0] for group in groups], sorted(group[0] for group in groups))
+        self.assertIn([0, 7, 9], groups)
+        self.assertEqual(ligand_groups(INPUT_FILE, deduplicate=False), [[i] for i in range(10)])
+
+
+class TestDeduplication(unittest.TestCase):
+
+    def test_deduplicated_scores_match(self):
+
+        # The fixture has several poses of the same ligands, which share the conformers of their first pose
+        deduplicated = [data for data, _ in score_poses(INPUT_FILE)]
+        every_pose = [data for data, _ in score_poses(INPUT_FILE, deduplicate=False)]
+
+        self.assertEqual(len(deduplicated), len(every_pose))
+        for pose, reference in zip(deduplicated, every_pose):
+            for column in ('RMSD to input conformation', 'probability score', 'normalised probability score'):
+                self.assertAlmostEqual(pose[column], reference[column], places=3, msg=pose['identifier'])
+
+
+if __name__ == '__main__':
+    unittest.main()
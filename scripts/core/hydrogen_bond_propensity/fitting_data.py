@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+# 2026-10-19: created by the Cambridge Crystallographic Data Centre
+
+"""Reuse of HBP fitting data, shared by hydrogen_bond_propensity_report.py and the multi-component HBP report.
+
+Both scripts keep the refcodes of fitting datasets found before, and set the fitting data of a new calculation to
+those CSD entries rather than searching the CSD again. Whether the fitting data of a calculation can be set depends
+on the version of the CSD Python API, so restore_fitting_data checks that it took effect, and warns when it falls
+back to searching.
+"""
+
+import functools
+
+from ccdc import io
+from ccdc.descriptors import CrystalDescriptors
+
+
+@functools.lru_cache(maxsize=None)
+def fitting_data_settable():
+    """Whether HBondPropensities has a fitting_data property that can be set, rather than only read.
+
+    This is checked once per process, and a warning printed if it cannot be set.
+    """
+    attribute = getattr(CrystalDescriptors.HBondPropensities, 'fitting_data', None)
+    if isinstance(attribute, property) and attribute.fset is not None:
+        return True
+    print('Warning! This version of the CSD Python API cannot set HBP fitting data, so cached or stored fitting data '
+          'is not used and the CSD is searched for it')
+    return False
+
+
+def restore_fitting_data(hbp, refcodes, source='cached'):
+    """Set the fitting data of a HBondPropensities calculation to the CSD entries with the given refcodes.
+
+    Args:
+        hbp: CrystalDescriptors.HBondPropensities calculation, with its target set
+        refcodes: Refcodes of the fitting data
+        source: Description of where the refcodes came from, for messages
+
+    Returns:
+        True if the fitting data was set; otherwise a warning is printed (only once per process if the API cannot
+        set fitting data at all) and False returned, and the fitting data should be matched as normal
+    """
+    if not fitting_data_settable():
+        return False
+
+    try:
+        csd_reader = io.EntryReader('CSD')
+        entries = [csd_reader.entry(refcode) for refcode in refcodes]
+        hbp.fitting_data = entries
+        n_restored = len(hbp.fitting_data)
+    except (AttributeError, TypeError, RuntimeError) as error:
+        print('Warning! %s fitting data could not be used, so the CSD is searched for it (%s)'
+              % (source.capitalize(), error))
+        return False
+
+    if n_restored != len(entries):
+        print('Warning! %s fitting data could not be used, so the CSD is searched for it (%d of %d structures set)'
+              % (source.capitalize(), n_restored, len(entries)))
+        return False
+
+    print('Using %s fitting data (%d structures)' % (source, n_restored))
+    return True
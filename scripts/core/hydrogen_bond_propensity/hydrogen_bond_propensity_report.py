@@ -15,6 +15,10 @@
 """
 hydrogen_bond_propensity_report.py
 - Writes a .docx report of a hydrogen bond propensity calculation
+- With --output_format json, writes the report data as JSON with an HTML view instead,
+  without needing Word or docxtpl
+- With --batch, screens a list of refcodes or a multi-structure file in parallel,
+  writing consolidated JSON and CSV files of the results
 """
 
 import argparse
@@ -22,7 +26,13 @@ import os
 import sys
 import subprocess
 import csv
+import json
+import hashlib
 import string
+import html
+from io import StringIO
+import multiprocessing
+import numpy as np
 import matplotlib
 
 matplotlib.use('Agg')
@@ -30,9 +40,19 @@ import matplotlib.pyplot as plt
 
 from ccdc import io
 from ccdc.diagram import DiagramGenerator
+from ccdc.molecule import Molecule
 from ccdc.search import SubstructureSearch, ConnserSubstructure
 from ccdc.descriptors import CrystalDescriptors
 
+from fitting_data import restore_fitting_data
+
+DOCXTPL_ERROR = """
+    The python-docx-template templating engine needed by this script could not
+    be found. Please run "{} -m pip install docxtpl"
+    to try to fix the issue.\nYou may need administrator's rights to do this.
+    """.format(sys.executable)
+
+# docxtpl is only needed for .docx reports, so JSON/HTML output works without it
 try:
     import warnings
 
@@ -41,27 +61,100 @@ try:
         import docxtpl
         from docx.shared import Cm
 except ImportError:
-    error_message = """
-    The python-docx-template templating engine needed by this script could not
-    be found. Please run "{} -m pip install docxtpl"
-    to try to fix the issue.\nYou may need administrator's rights to do this.
-    """.format(sys.executable)
-    raise ImportError(error_message)
+    docxtpl = None
 
 SCRIPT_DIR = os.path.dirname(__file__)
 TEMPLATE_FILENAME = 'hydrogen_bond_propensity_report.docx'
 TEMPLATE_FILE = os.path.join(SCRIPT_DIR, TEMPLATE_FILENAME)
+SCREEN_FILENAME = 'hbp_screen'
+
+# Default number of processes drawing report images while the calculation runs
+IMAGE_PROCESSES = 2
+
+# 11 colours for alternative networks in the HBP chart
+CHART_COLOURS = {'#00AEEF': 'lightblue', '#D63868': 'violetred', '#6E3776': 'plum', '#B5B800': 'pear',
+                 '#1C5797': 'darkblue', '#FF9A0F': 'orange', '#128A00': 'green', '#D2A106': 'yellow',
+                 '#062D56': 'navy', '#00A5A8': 'turquoise', '#EB050C': 'red'}
+
+# Page of the HTML view of a JSON report
+HTML_TEMPLATE = string.Template("""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Hydrogen Bond Propensity Report: $identifier</title>
+<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; margin-bottom: 1.5em; }
+th, td { border: 1px solid #999999; padding: 0.2em 0.6em; text-align: left; }
+th { background: #E0E0E0; }
+</style>
+</head>
+<body>
+<h1>Hydrogen Bond Propensity Report: $identifier</h1>
+$body
+</body>
+</html>
+""")
+
+# Diagram settings for each kind of image in the report
+DIAGRAM_STYLES = {
+    'diagram': {'line_width': 1.6, 'font_size': 12, 'image_height': 300},
+    'component': {'line_width': 1.6, 'font_size': 10, 'image_height': 300, 'shrink_symbols': False},
+    'functional_group': {'shrink_symbols': False, 'element_coloring': False},
+}
 
 
 ###############################################################################
+class FittingDataCache:
+    """Persistent cache of HBP fitting datasets, keyed by functional-group signature.
+
+    Structures with the same set of functional groups are fitted against the same CSD data,
+    so the refcodes of the fitting dataset found for one are stored and reused for the next,
+    together with a summary of the model fitted to them. Each record is kept in its own JSON
+    file in the cache directory, so that batch worker processes can share the cache.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(functional_groups, fg_count, settings):
+        # The signature covers everything that determines the fitting data and model
+        signature = {
+            'functional_groups': sorted(fg.identifier for fg in functional_groups),
+            'fg_count': fg_count,
+            'require_hydrogens': settings.hbond_criterion.require_hydrogens,
+            'path_length_range': list(settings.hbond_criterion.path_length_range),
+            'csd_version': io.csd_version(),
+        }
+        return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest(), signature
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, '%s.json' % key)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, record):
+        # Write to a temporary file first, so that a half-written record is never read
+        fname = os.path.join(self.directory, '%s.json' % key)
+        with open('%s.%d.tmp' % (fname, os.getpid()), 'w') as outfile:
+            json.dump(record, outfile)
+        os.replace('%s.%d.tmp' % (fname, os.getpid()), fname)
+
+
 class PropensityCalc:
     "HBP Calculator"
-    def __init__(self, crystal, work_directory, min_donor_coordination, min_acceptor_coordination, fg_count):
+    def __init__(self, crystal, work_directory, min_donor_coordination, min_acceptor_coordination, fg_count,
+                 cache=None):
         self.crystal = crystal
         self.directory = work_directory
         self.min_donor_coordination = min_donor_coordination
         self.min_acceptor_coordination = min_acceptor_coordination
         self.fg_count = fg_count
+        self.cache = cache
         self.settings = self._hbp_settings()
         self.hbp = CrystalDescriptors.HBondPropensities()
 
@@ -80,8 +173,14 @@ class PropensityCalc:
         self.hbp.set_target(self.crystal)
         print(self.hbp.functional_groups)
 
-        # Generate Training Dataset
-        self.hbp.match_fitting_data(count=self.fg_count)  # set to >300, preferably 500 for better representation of functional groups
+        # Generate Training Dataset, from the cache if the same functional groups have been fitted before
+        cache_record = None
+        if self.cache is not None:
+            cache_key, signature = self.cache.key(self.hbp.functional_groups, self.fg_count, self.settings)
+            cache_record = self.cache.get(cache_key)
+        if cache_record is None or not restore_fitting_data(self.hbp, cache_record['refcodes'], 'cached'):
+            cache_record = None
+            self.hbp.match_fitting_data(count=self.fg_count)  # set to >300, preferably 500 for better representation of functional groups
 
         self.hbp.analyse_fitting_data()
 
@@ -96,6 +195,18 @@ class PropensityCalc:
         print(model.equation)
         print('Area under ROC curve: {} -- {}'.format(round(model.area_under_roc_curve, 3), model.advice_comment))
 
+        if self.cache is not None:
+            if cache_record is None:
+                self.cache.put(cache_key, {
+                    'signature': signature,
+                    'refcodes': [entry.identifier for entry in self.hbp.fitting_data],
+                    'model': {'equation': model.equation,
+                              'area_under_roc_curve': model.area_under_roc_curve,
+                              'advice_comment': model.advice_comment},
+                })
+            elif round(cache_record['model']['area_under_roc_curve'], 3) != round(model.area_under_roc_curve, 3):
+                print('Warning! Model fitted to cached fitting data differs from the cached model')
+
         propensities = self.hbp.calculate_propensities()
 
         intra_flag = True if len(self.hbp.intra_propensities) > 0 else False
@@ -123,20 +234,29 @@ class PropensityCalc:
                 intra_obs)
 
 
+_diagram_generators = {}
+
+
+def diagram_generator(style):
+    # Diagram generators are created once per process for each style, then shared by all images of that style
+    if style not in _diagram_generators:
+        generator = DiagramGenerator()
+        for setting, value in DIAGRAM_STYLES[style].items():
+            setattr(generator.settings, setting, value)
+        _diagram_generators[style] = generator
+    return _diagram_generators[style]
+
+
 def make_diagram(mol, directory):
     # Generates a diagram from a given structure
-    molecule_diagram_generator = DiagramGenerator()
-    molecule_diagram_generator.settings.line_width = 1.6
-    molecule_diagram_generator.settings.font_size = 12
-    molecule_diagram_generator.settings.image_height = 300
-    img = molecule_diagram_generator.image(mol)
+    img = diagram_generator('diagram').image(mol)
     fname = str(os.path.join(directory, '%s_diagram.png' % mol.identifier))
     if img:
         img.save(fname)
     return fname
 
 
-def generate_component_pics(input_mol, molecule_diagram_generator, directory, docx_template):
+def generate_component_pics(input_mol, directory):
     non_ch_molecule_no = 0
     component_diagrams = []
     donor_acceptor_check = []
@@ -146,26 +266,17 @@ def generate_component_pics(input_mol, molecule_diagram_generator, directory, do
         donor_acceptor_check = [atom for atom in atoms if atom.is_donor or atom.is_acceptor]
 
         if donor_acceptor_check:
-            img = molecule_diagram_generator.image(m, highlight_atoms=None, label_atoms=donor_acceptor_check)
+            img = diagram_generator('component').image(m, highlight_atoms=None, label_atoms=donor_acceptor_check)
             non_ch_molecule_no += 1
             fname = str(os.path.join(directory, '%s_component_%s.png' % (input_mol.identifier, non_ch_molecule_no)))
             if img:
                 img.save(fname)
-            non_ch_img = add_picture_subdoc(fname, docx_template)
-            component_diagrams.append(non_ch_img)
+            component_diagrams.append(fname)
     return component_diagrams
 
 
-def make_diagram_components(crystal, molecule, directory, docx_template):
-    # Generates a diagram for each component in a given structure, with D/A atoms labelled if component has a donor/acceptor
-    molecule_diagram_generator = DiagramGenerator()
-    molecule_diagram_generator.settings.line_width = 1.6
-    molecule_diagram_generator.settings.font_size = 10
-    molecule_diagram_generator.settings.image_height = 300
-    molecule_diagram_generator.settings.shrink_symbols = False
-
-    asymmetric_molecule = crystal.asymmetric_unit_molecule
-
+def diagram_components_molecule(crystal, molecule):
+    # Chooses the molecule whose components are drawn, with D/A atoms labelled if component has a donor/acceptor
     # If no Z and Z' information (e.g. mol2), 'None' is returned for crystal.z_prime
     z_prime_flag = False
     if crystal.z_prime:
@@ -173,30 +284,77 @@ def make_diagram_components(crystal, molecule, directory, docx_template):
 
     # Generates an image for every molecule
     if z_prime_flag and crystal.z_prime < 1:
-        component_diagrams = generate_component_pics(molecule, molecule_diagram_generator, directory, docx_template)
+        return molecule
     # Generates an image for every molecule in the asymmetric unit
-    else:
-        component_diagrams = generate_component_pics(asymmetric_molecule, molecule_diagram_generator, directory, docx_template)
-
-    return component_diagrams
+    return crystal.asymmetric_unit_molecule
 
 
 def fg_diagram(mol, directory, con):
     # Create highlighted functional group diagrams
-    diagram_generator = DiagramGenerator()
-    diagram_generator.settings.shrink_symbols = False
-    diagram_generator.settings.element_coloring = False
     searcher = SubstructureSearch()
     searcher.add_substructure(ConnserSubstructure(os.path.join(directory, "%s.con" % con)))
     hits = searcher.search(mol)
     selection = hits[0].match_atoms()
-    img = diagram_generator.image(mol, highlight_atoms=selection)
+    img = diagram_generator('functional_group').image(mol, highlight_atoms=selection)
     fname = str(os.path.join(directory, '%s.png' % con))
     if img:
         img.save(fname)
     return fname
 
 
+def render_structure_images(mol2, components_mol2, directory):
+    # Renders the structure diagram and component diagrams; may run in an image worker process,
+    # so the molecules are passed as mol2 strings
+    diagram_file = make_diagram(Molecule.from_string(mol2, 'mol2'), directory)
+    component_files = generate_component_pics(Molecule.from_string(components_mol2, 'mol2'), directory)
+    return diagram_file, component_files
+
+
+def render_fg_diagram(mol2, directory, con):
+    # Renders a functional group diagram; may run in an image worker process
+    return fg_diagram(Molecule.from_string(mol2, 'mol2'), directory, con)
+
+
+class ImageRenderer:
+    """Renders report images on a pool of worker processes, so that they are drawn while the
+    HBP calculation runs; with no processes, images are rendered in this process when submitted.
+    Used as a context manager, the pool is closed on leaving, and stopped if an error is raised.
+    """
+    def __init__(self, processes=0):
+        self.pool = multiprocessing.Pool(processes) if processes else None
+        self.pending = {}
+
+    def submit(self, name, function, *args):
+        if self.pool is None:
+            result = function(*args)
+            self.pending[name] = lambda: result
+        else:
+            self.pending[name] = self.pool.apply_async(function, args).get
+
+    def submit_structure_images(self, crystal, directory):
+        self.submit('structure', render_structure_images, crystal.molecule.to_string('mol2'),
+                    diagram_components_molecule(crystal, crystal.molecule).to_string('mol2'), directory)
+
+    def result(self, name):
+        return self.pending.pop(name)()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.close()
+
+
 def add_picture_subdoc(picture_location, docx_template, cm=7):
     # This function adds a picture to the .docx file
     return docxtpl.InlineImage(
@@ -244,80 +402,70 @@ def normalize_molecule(molecule):
     molecule.standardise_delocalised_bonds()
 
 
-def chart_output(groups, work_directory, structure):
+def landscape_arrays(groups):
+    # Extract the scores of the alternative networks once, as arrays for charting and output
+    hbond_scores = np.array([group.hbond_score for group in groups], dtype=float)
+    coordination_scores = np.array([group.coordination_score for group in groups], dtype=float)
+    hbond_counts = np.array([len(group.hbonds) for group in groups], dtype=int)
+    hbonds = ['; '.join(['%s - %s' % (g.donor.label, g.acceptor.label) for g in group.hbonds]) for group in groups]
+    return hbond_scores, coordination_scores, hbond_counts, hbonds
+
+
+def chart_output(landscape, work_directory, structure):
     # Write out the data points of the HBP chart to a file
+    hbond_scores, coordination_scores, hbond_counts, hbonds = landscape
     with open(os.path.join(work_directory, '%s_chart_data.csv' % structure), 'w') as outfile:
         csv_writer = csv.writer(outfile)
         csv_writer.writerow(['Mean Propensity', 'Mean Coordination Score', 'Hydrogen Bonds'])
-        for group in groups:
-            csv_writer.writerow(
-                [group.hbond_score,
-                 group.coordination_score,
-                 '; '.join(['%s - %s' % (g.donor.label, g.acceptor.label) for g in group.hbonds])]
-            )
-
-def hbp_landscape(groups, observed_groups, crystal, directory, work_directory, docx_template):
-    # Generate the HBP chart
-
-    # 11 colours for alternative networks
-    chart_colours = {'#00AEEF': 'lightblue', '#D63868': 'violetred', '#6E3776': 'plum', '#B5B800': 'pear',
-                     '#1C5797': 'darkblue', '#FF9A0F': 'orange', '#128A00': 'green', '#D2A106': 'yellow',
-                     '#062D56': 'navy', '#00A5A8': 'turquoise', '#EB050C': 'red'}
-    hbp_colours = list(chart_colours.keys())
+        csv_writer.writerows(zip(hbond_scores.tolist(), coordination_scores.tolist(), hbonds))
 
+def landscape_bins(hbond_counts, obs_pairs):
+    # Assign each alternative network to a colour of the HBP chart by its number of pairs (-1 for none)
     # If 10 pairs or less in network with highest number of pairs start colour at 0 - static legend
     # otherwise use colours relative to observed (orange, 6th colour, index5) - dynamic legend
-    # For half-transparent white edges for triangles, use (1, 1, 1, 0.5) or matplotlib.colors.colorConverter.to_rgba('white', alpha=.5)
-    colour_pairs = []
-    count_pairs = []
     mpair_flag = False
-    obs_pairs = len(observed_groups.hbonds)
+    n_colours = len(CHART_COLOURS)
 
     # Check highest number of pairs for alternative networks
     # If no alternative network generated, use number of pairs in observed structure
-    try:
-        num_alt_pairs = [len(group.hbonds) for group in groups]
-        max_alt_pairs = max(num_alt_pairs)
-        highest_pairs = max(max_alt_pairs, obs_pairs)
-    except:
-        highest_pairs = obs_pairs
+    highest_pairs = max(hbond_counts.max(), obs_pairs) if hbond_counts.size else obs_pairs
 
-    # Static legend
+    # Static legend: one bin for each of 0 to 10 pairs
     if highest_pairs <= 10 or obs_pairs < 6:
-        for i, colour in enumerate(hbp_colours):
-            figure_i = plt.scatter([group.hbond_score for group in groups if len(group.hbonds) == i],
-                               [abs(group.coordination_score) for group in groups if len(group.hbonds) == i],
-                               c=hbp_colours[i], marker='v', s=75, edgecolors=(1, 1, 1, 0.5), linewidth=0.3, clip_on=False)
-            colour_pairs.append(i)
-            count_pairs.append(len([group for group in groups if len(group.hbonds) == i]))
-    # Dynamic legend
+        colour_pairs = list(range(n_colours))
+        bins = np.where(hbond_counts < n_colours, hbond_counts, -1)
+    # Dynamic legend: bins from 5 fewer to 5 more pairs than observed, the first and last bins
+    # also taking all networks with fewer or more pairs
     else:
-        relative_range = range(5, -6, -1)
-        for i, (value, colour) in enumerate(zip(relative_range, hbp_colours)):
-            r = obs_pairs - value
-            if i == 0:
-                figure_i = plt.scatter([group.hbond_score for group in groups if len(group.hbonds) <= r],
-                    [abs(group.coordination_score) for group in groups if len(group.hbonds) <= r],
-                    c=hbp_colours[i], marker='v', s=75, edgecolors=(1, 1, 1, 0.5), linewidth=0.3, clip_on=False)
-                count_pairs.append(len([group for group in groups if len(group.hbonds) <= r]))
-                mpair_flag = True
-            elif i in range(1, 10):
-                figure_i = plt.scatter([group.hbond_score for group in groups if len(group.hbonds) == r],
-                                   [abs(group.coordination_score) for group in groups if len(group.hbonds) == r],
-                                   c=hbp_colours[i], marker='v', s=75, edgecolors=(1, 1, 1, 0.5), linewidth=0.3, clip_on=False)
-                count_pairs.append(len([group for group in groups if len(group.hbonds) == r]))
-            elif i == 10:
-                figure_i = plt.scatter([group.hbond_score for group in groups if len(group.hbonds) >= r],
-                    [abs(group.coordination_score) for group in groups if len(group.hbonds) >= r],
-                    c=hbp_colours[i], marker='v', s=75, edgecolors=(1, 1, 1, 0.5), linewidth=0.3, clip_on=False)
-                count_pairs.append(len([group for group in groups if len(group.hbonds) >= r]))
-                mpair_flag = True
-            colour_pairs.append(r)
+        colour_pairs = [obs_pairs + value for value in range(-5, 6)]
+        bins = np.clip(hbond_counts, colour_pairs[0], colour_pairs[-1]) - colour_pairs[0]
+        mpair_flag = True
+
+    count_pairs = np.bincount(bins[bins >= 0], minlength=n_colours).tolist()
+
+    return colour_pairs, count_pairs, mpair_flag, bins
+
+
+def plot_landscape(landscape, observed_groups, output, output_format='png'):
+    # Draw the HBP chart, saving it to a file name or file object
+    hbond_scores, coordination_scores, hbond_counts, _ = landscape
+    coordination_scores = np.abs(coordination_scores)
+    _, _, _, bins = landscape_bins(hbond_counts, len(observed_groups.hbonds))
+
+    # Start a new figure, so that charts for several structures in one process do not overlap
+    plt.figure()
+
+    # For half-transparent white edges for triangles, use (1, 1, 1, 0.5) or matplotlib.colors.colorConverter.to_rgba('white', alpha=.5)
+    for i, colour in enumerate(CHART_COLOURS):
+        mask = bins == i
+        if mask.any():
+            plt.scatter(hbond_scores[mask], coordination_scores[mask],
+                        c=colour, marker='v', s=75, edgecolors=(1, 1, 1, 0.5), linewidth=0.3, clip_on=False)
 
     # Observed network (plotted after other networks so point on top)
-    ax2 = plt.scatter(observed_groups.hbond_score,
-                      abs(observed_groups.coordination_score),
-                      c='white', marker='o', s=75, edgecolors='black', linewidth=1.6, clip_on=False)
+    plt.scatter(observed_groups.hbond_score,
+                abs(observed_groups.coordination_score),
+                c='white', marker='o', s=75, edgecolors='black', linewidth=1.6, clip_on=False)
 
     plt.origin = 'upper'
     plt.xlim(0, 1.0)
@@ -328,66 +476,116 @@ def hbp_landscape(groups, observed_groups, crystal, directory, work_directory, d
     ax.set_xlabel('Mean H-Bond Propensity')
     ax.set_ylabel('Mean H-Bond Co-ordination')
     ax.xaxis.set_label_position('top')
-    figure_location = os.path.join(directory, '%s_standard_chart.png' % crystal.identifier)
-    plt.savefig(figure_location, bbox_inches='tight', pad_inches=0.0)
-
-    chart = add_picture_subdoc(figure_location, docx_template, cm=12.8)
-
-    diagram_file = make_diagram(crystal.molecule, directory)
-    diagram = add_picture_subdoc(diagram_file, docx_template)
+    plt.savefig(output, format=output_format, bbox_inches='tight', pad_inches=0.0)
+    plt.close()
 
-    con_files = [f[:-4] for f in os.listdir(work_directory) if f.endswith(".con")]
-    fg_pics = [fg_diagram(crystal.molecule, work_directory, con) for con in con_files]
-    fg_diagrams = {con: add_picture_subdoc(os.path.join(work_directory, '%s.png' % con), docx_template)
-                   for con in con_files}
 
-    return chart, diagram, fg_diagrams, colour_pairs, obs_pairs, count_pairs, mpair_flag
+def hbp_landscape(landscape, observed_groups, crystal, directory, docx_template):
+    # Generate the HBP chart for the .docx report
+    figure_location = os.path.join(directory, '%s_standard_chart.png' % crystal.identifier)
+    plot_landscape(landscape, observed_groups, figure_location)
+    return add_picture_subdoc(figure_location, docx_template, cm=12.8)
 
 
-def main(structure, directory, csdrefcode, min_donor_coordination, min_acceptor_coordination, fg_count, noopen=False):
-    # This looks for the .docx template that is used to generate the report from
-    if os.path.isfile(TEMPLATE_FILE):
-        docx_template = docxtpl.DocxTemplate(TEMPLATE_FILE)
-    else:
-        print('Error! {} not found!'.format(TEMPLATE_FILENAME))
-        quit()
-
+def load_crystal(structure, csdrefcode):
     # This loads up the CSD if a refcode is requested, otherwise loads the structural file supplied
     if csdrefcode:
         try:
             crystal = io.CrystalReader('CSD').crystal(str(structure))
         except RuntimeError:
-            print('Error! %s is not in the database!' % str(structure))
-            quit()
+            raise ValueError('%s is not in the database!' % str(structure))
     else:
         crystal = io.CrystalReader(str(structure))[0]
+    return prepare_crystal(crystal, structure)
 
+
+def prepare_crystal(crystal, structure):
     # If there are atoms without sites, or there are no atoms in the structure, then HBP cannot be performed
     molecule = crystal.molecule
     if not molecule.all_atoms_have_sites or len(molecule.atoms) == 0:
-        print('Error! Not all atoms in %s have sites!' % str(structure))
-        quit()
+        raise ValueError('Not all atoms in %s have sites!' % str(structure))
 
     # Bond types need to be standardised
     normalize_molecule(molecule)
     crystal.molecule = molecule
+    return crystal
+
+
+def run_calculation(crystal, work_directory, min_donor_coordination, min_acceptor_coordination, fg_count,
+                    cache_directory=None):
+    # Run the HBP calculation and calculate the coordination scores separately
+    cache = FittingDataCache(cache_directory) if cache_directory else None
+    hbp_calculator = PropensityCalc(crystal, work_directory, min_donor_coordination,
+                                    min_acceptor_coordination, fg_count, cache)
+    results = hbp_calculator.calculate()
+    coordination_scores = coordination_scores_calc(crystal, work_directory)
+    return results, coordination_scores
+
+
+def check_docx_requirements():
+    # Writing .docx reports needs docxtpl and the .docx template that is used to generate the report from
+    if docxtpl is None:
+        raise ImportError(DOCXTPL_ERROR)
+    if not os.path.isfile(TEMPLATE_FILE):
+        print('Error! {} not found!'.format(TEMPLATE_FILENAME))
+        quit()
+
+
+def main(structure, directory, csdrefcode, min_donor_coordination, min_acceptor_coordination, fg_count, noopen=False,
+         cache_directory=None, image_processes=IMAGE_PROCESSES, output_format='docx'):
+    if output_format == 'docx':
+        check_docx_requirements()
+
+    try:
+        crystal = load_crystal(structure, csdrefcode)
+    except ValueError as error:
+        print('Error! %s' % error)
+        quit()
 
     # Set up a work directory for the HBP files
     work_directory = os.path.join(directory, str(structure).split('.')[0])
 
-    hbp_calculator = PropensityCalc(crystal, work_directory, min_donor_coordination,
-                                    min_acceptor_coordination, fg_count)
+    # Start drawing the structure diagrams while the propensity model is fitted; JSON reports have no diagrams
+    with ImageRenderer(image_processes if output_format == 'docx' else 0) as renderer:
+        if output_format == 'docx':
+            renderer.submit_structure_images(crystal, directory)
 
-    # Get all the necessary data from a HBP calculation
-    (functional_groups, fitting_data, donors, acceptors, model, propensities, intra_flag, groups, observed_groups,
-     min_donor_coordination, min_acceptor_coordination, intra_count, intra_obs) = hbp_calculator.calculate()
+        results, coordination_scores = run_calculation(crystal, work_directory, min_donor_coordination,
+                                                       min_acceptor_coordination, fg_count, cache_directory)
 
-    # Calculate the coordination scores separately
-    coordination_scores = coordination_scores_calc(crystal, work_directory)
-    mean_coordination = abs(observed_groups.coordination_score) ## abs() not built into in jinja2 (docx) template
+        write_report(crystal, structure, directory, work_directory, results, coordination_scores, noopen, renderer,
+                     output_format)
+
+
+def write_report(crystal, structure, directory, work_directory, results, coordination_scores, noopen=False,
+                 renderer=None, output_format='docx'):
+    # Write the report of a HBP calculation, either as a .docx file or as JSON with an HTML view
+    groups, observed_groups = results[7], results[8]
 
     # Create the HBP chart output as a separate file
-    chart_output(groups, work_directory, structure)
+    landscape = landscape_arrays(groups)
+    chart_output(landscape, work_directory, structure)
+
+    context = report_context(crystal, results, coordination_scores, landscape)
+
+    if output_format == 'json':
+        output_file = write_json_report(crystal, directory, context, landscape, observed_groups)
+    else:
+        output_file = write_docx_report(crystal, directory, work_directory, context, landscape, observed_groups,
+                                        renderer)
+
+    if not noopen:
+        launch_word_processor(output_file)
+    print('Output file written to %s' % output_file)
+
+
+def report_context(crystal, results, coordination_scores, landscape):
+    # Collect the information given to the report template from the results of a HBP calculation;
+    # the chart and diagrams are added by the .docx backend
+    (functional_groups, fitting_data, donors, acceptors, model, propensities, intra_flag, groups, observed_groups,
+     min_donor_coordination, min_acceptor_coordination, intra_count, intra_obs) = results
+
+    mean_coordination = abs(observed_groups.coordination_score) ## abs() not built into in jinja2 (docx) template
 
     # Set up some dictionaries and fill them with coordination score data, as well as extra information for the report
     dscores = {}
@@ -424,17 +622,13 @@ def main(structure, directory, csdrefcode, min_donor_coordination, min_acceptor_
     don = list(set(list("%s_d" % p.donor_label.split(" ")[0] for p in propensities)))
     acc = list(set(list("%s_a" % p.acceptor_label.split(" ")[0] for p in propensities)))
 
-    # Generate HBP landscape chart
-    chart, diagram, fg_diagrams, colour_pairs, obs_pairs, count_pairs, mpair_flag = hbp_landscape(groups, observed_groups, crystal, directory, work_directory, docx_template)
-
-    # Save 2D diagrams of each chemical component in the asu with non-CH labelled for the SI hbp figure
-    component_diagrams = make_diagram_components(crystal, molecule, directory, docx_template)
+    # Colour legend of the HBP landscape chart
+    colour_pairs, count_pairs, mpair_flag, _ = landscape_bins(landscape[2], len(observed_groups.hbonds))
 
     # The context is the information that is given to the template to allow it to be populated
-    context = {
+    return {
         # Title page
         'identifier': crystal.identifier,
-        'chart': chart,
         'propensities': propensities,
         'intra_flag': intra_flag,
         'coord_cols': coord_cols,
@@ -444,10 +638,8 @@ def main(structure, directory, csdrefcode, min_donor_coordination, min_acceptor_
         'dbg': dcoord_bg,
         'ascores': ascores,
         'abg': acoord_bg,
-        'diagram': diagram,
         'don': don,
         'acc': acc,
-        'fg_diagrams': fg_diagrams,
         'functional_groups': functional_groups,
         'data': fitting_data,
         'len_data': len(fitting_data),
@@ -455,26 +647,296 @@ def main(structure, directory, csdrefcode, min_donor_coordination, min_acceptor_
         'model': model,
         'abc': abc,
         'colour_pairs': colour_pairs,
-        'obs_pairs': obs_pairs,
+        'obs_pairs': len(observed_groups.hbonds),
         'count_pairs': count_pairs,
         'min_donor_coordination': min_donor_coordination,
         'min_acceptor_coordination': min_acceptor_coordination,
         'mpair_flag': mpair_flag,
-        'component_diagrams': component_diagrams,
         'observed_groups': observed_groups,
         'mean_coordination': mean_coordination,
         'intra_count': intra_count,
         'intra_obs': intra_obs
     }
 
+
+def write_docx_report(crystal, directory, work_directory, context, landscape, observed_groups, renderer=None):
+    # Render the report context to the .docx template, with the chart and diagrams as pictures
+    if renderer is None:
+        with ImageRenderer() as renderer:
+            return write_docx_report(crystal, directory, work_directory, context, landscape, observed_groups,
+                                     renderer)
+
+    docx_template = docxtpl.DocxTemplate(TEMPLATE_FILE)
+
+    # Images not already submitted to the renderer are submitted now, to be drawn alongside the chart
+    if 'structure' not in renderer.pending:
+        renderer.submit_structure_images(crystal, directory)
+    con_files = [f[:-4] for f in os.listdir(work_directory) if f.endswith(".con")]
+    mol2 = crystal.molecule.to_string('mol2')
+    for con in con_files:
+        renderer.submit(con, render_fg_diagram, mol2, work_directory, con)
+
+    # Generate HBP landscape chart
+    context['chart'] = hbp_landscape(landscape, observed_groups, crystal, directory, docx_template)
+
+    # Collect the 2D diagram, the diagrams of each chemical component in the asu with non-CH labelled for the SI hbp
+    # figure, and the highlighted functional group diagrams
+    diagram_file, component_files = renderer.result('structure')
+    context['diagram'] = add_picture_subdoc(diagram_file, docx_template)
+    context['component_diagrams'] = [add_picture_subdoc(fname, docx_template) for fname in component_files]
+    context['fg_diagrams'] = {con: add_picture_subdoc(renderer.result(con), docx_template) for con in con_files}
+
     # Send all the information to the template file then open up the final report
     docx_template.render(context)
     output_file = os.path.join(directory, '%s_propensity_report.docx' % crystal.identifier)
     docx_template.save(output_file)
+    return output_file
+
+
+def report_data(context, landscape):
+    # Convert the report context to plain data for JSON output, keeping the fields used by the .docx template
+    data = context['data']
+
+    def da_data(da):
+        return {'label': da.label, 'functional_group': da.functional_group_identifier,
+                'formal_charge': da.atom.formal_charge, 'npositive': da.npositive, 'nnegative': da.nnegative}
+
+    hbond_scores, coordination_scores, hbond_counts, hbonds = landscape
+    observed_groups = context['observed_groups']
+
+    report = {key: context[key] for key in ('identifier', 'intra_flag', 'coord_cols', 'dscores', 'dbg', 'ascores',
+                                            'abg', 'don', 'acc', 'len_data', 'colour_pairs', 'obs_pairs',
+                                            'count_pairs', 'min_donor_coordination', 'min_acceptor_coordination',
+                                            'mpair_flag', 'mean_coordination', 'intra_count', 'intra_obs')}
+    report.update({
+        'propensities': [{'donor': da_data(p.donor), 'acceptor': da_data(p.acceptor),
+                          'donor_label': p.donor_label, 'acceptor_label': p.acceptor_label,
+                          'propensity': p.propensity, 'bounds': list(p.bounds),
+                          'donor_rank': p.donor_rank, 'acceptor_rank': p.acceptor_rank,
+                          'hbond_count': p.hbond_count, 'is_observed': p.is_observed,
+                          'is_intermolecular': p.is_intermolecular,
+                          'is_donor_bifurcated': p.is_donor_bifurcated,
+                          'is_acceptor_bifurcated': p.is_acceptor_bifurcated}
+                         for p in context['propensities']],
+        'donors': [da_data(d) for d in context['donors']],
+        'acceptors': [da_data(a) for a in context['acceptors']],
+        'functional_groups': [{'identifier': g.identifier, 'nitems': data.nitems(g),
+                               'advice_comment': data.advice_comment(g)}
+                              for g in context['functional_groups']],
+        'data_advice_comment': data.advice_comment(),
+        'coefficients': [{'identifier': c.identifier, 'estimate': c.estimate, 'standard_error': c.standard_error,
+                          'z_value': c.z_value, 'p_value': c.p_value,
+                          'confidence_interval': list(c.confidence_interval),
+                          'significance_code': c.significance_code}
+                         for c in context['coefficients']],
+        'model': {'area_under_roc_curve': context['model'].area_under_roc_curve,
+                  'advice_comment': context['model'].advice_comment},
+        'observed_groups': {'hbond_score': observed_groups.hbond_score,
+                            'coordination_score': observed_groups.coordination_score,
+                            'hbonds': ['%s - %s' % (g.donor.label, g.acceptor.label) for g in observed_groups.hbonds]},
+        'landscape': {'mean_propensity': hbond_scores.tolist(),
+                      'mean_coordination': np.abs(coordination_scores).tolist(),
+                      'hbond_count': hbond_counts.tolist(),
+                      'hbonds': hbonds},
+    })
+    return report
+
+
+def html_table(header, rows, backgrounds=None):
+    # Format a table of the HTML report, optionally with a background colour for each cell
+    lines = ['<table>', '<tr>%s</tr>' % ''.join('<th>%s</th>' % html.escape(str(h)) for h in header)]
+    for i, row in enumerate(rows):
+        cells = []
+        for j, value in enumerate(row):
+            style = ' style="background: #%s"' % backgrounds[i][j] if backgrounds and backgrounds[i][j] else ''
+            cells.append('<td%s>%s</td>' % (style, html.escape(str(value))))
+        lines.append('<tr>%s</tr>' % ''.join(cells))
+    lines.append('</table>')
+    return '\n'.join(lines)
+
+
+def html_report(report, chart_svg):
+    # Format the HTML view of a JSON report, with the HBP chart as inline SVG
+    sections = ['<h2>Hydrogen Bond Propensity Chart</h2>', chart_svg,
+                html_table(['Colour', 'Pairs', 'Networks'],
+                           [[name, pairs, count] for name, pairs, count in
+                            zip(CHART_COLOURS.values(), report['colour_pairs'], report['count_pairs'])],
+                           [[colour[1:], '', ''] for colour in CHART_COLOURS]),
+                '<p>Observed network: mean propensity %0.2f, mean co-ordination %0.2f, %d pairs</p>'
+                % (report['observed_groups']['hbond_score'], report['mean_coordination'], report['obs_pairs'])]
+
+    for title, intermolecular in (('Intermolecular', True), ('Intramolecular', False)):
+        rows = [[p['donor_label'], p['acceptor_label'], round(p['propensity'], 3),
+                 '%0.3f - %0.3f' % tuple(p['bounds']), p['donor_rank'], p['acceptor_rank'],
+                 'Yes' if p['is_observed'] else 'No']
+                for p in report['propensities'] if p['is_intermolecular'] == intermolecular]
+        if rows:
+            sections.append('<h2>%s Hydrogen Bond Propensities</h2>' % title)
+            sections.append(html_table(['Donor', 'Acceptor', 'Propensity', 'Confidence Interval', 'Donor Rank',
+                                        'Acceptor Rank', 'Observed'], rows))
+
+    for title, das, scores, backgrounds in (('Donor', report['donors'], report['dscores'], report['dbg']),
+                                            ('Acceptor', report['acceptors'], report['ascores'], report['abg'])):
+        sections.append('<h2>%s Coordination Likelihood</h2>' % title)
+        sections.append(html_table(['Label'] + report['coord_cols'],
+                                   [[da['label']] + scores[da['label']] for da in das],
+                                   [[''] + backgrounds[da['label']] for da in das]))
+
+    sections.append('<h2>Functional Groups</h2>')
+    sections.append(html_table(['Functional Group', 'Hits', 'Comment'],
+                               [[g['identifier'], g['nitems'], g['advice_comment']]
+                                for g in report['functional_groups']]))
+
+    sections.append('<h2>Model</h2>')
+    sections.append('<p>Fitting data: %d structures. Area under ROC curve: %0.3f. %s</p>'
+                    % (report['len_data'], report['model']['area_under_roc_curve'],
+                       html.escape(str(report['model']['advice_comment']))))
+    sections.append(html_table(['Coefficient', 'Estimate', 'Standard Error', 'Z Value', 'P Value', 'Significance'],
+                               [[c['identifier'], round(c['estimate'], 3), c['standard_error'], c['z_value'],
+                                 c['p_value'], c['significance_code']] for c in report['coefficients']]))
+
+    return HTML_TEMPLATE.substitute(identifier=html.escape(report['identifier']), body='\n'.join(sections))
+
+
+def write_json_report(crystal, directory, context, landscape, observed_groups):
+    # Write the report context as JSON, and an HTML view of it with the HBP chart as inline SVG
+    report = report_data(context, landscape)
+    json_file = os.path.join(directory, '%s_propensity_report.json' % crystal.identifier)
+    with open(json_file, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    print('Report data written to %s' % json_file)
+
+    svg = StringIO()
+    plot_landscape(landscape, observed_groups, svg, 'svg')
+    chart_svg = svg.getvalue()
+    chart_svg = chart_svg[chart_svg.index('<svg'):]
+
+    output_file = os.path.join(directory, '%s_propensity_report.html' % crystal.identifier)
+    with open(output_file, 'w') as outfile:
+        outfile.write(html_report(report, chart_svg))
+    return output_file
+
+
+def summarise_results(crystal, results, coordination_scores):
+    # Collect the results of a HBP calculation as plain data, for consolidated screening output
+    (functional_groups, fitting_data, donors, acceptors, model, propensities, intra_flag, groups, observed_groups,
+     min_donor_coordination, min_acceptor_coordination, intra_count, intra_obs) = results
+
+    coordination = []
+    for das, d_type in ((donors, 'd'), (acceptors, 'a')):
+        for da in das:
+            predicted, scores = coordination_scores.predictions_for_label(da.label, d_type)
+            coordination.append({'label': da.label, 'type': d_type, 'predicted': predicted,
+                                 'scores': [round(score, 3) for score in scores]})
+
+    def landscape_point(group, observed):
+        return {'mean_propensity': group.hbond_score,
+                'mean_coordination': abs(group.coordination_score),
+                'hbond_count': len(group.hbonds),
+                'hbonds': '; '.join(['%s - %s' % (g.donor.label, g.acceptor.label) for g in group.hbonds]),
+                'observed': observed}
+
+    return {
+        'identifier': crystal.identifier,
+        'status': 'success',
+        'functional_groups': [fg.identifier for fg in functional_groups],
+        'len_data': len(fitting_data),
+        'area_under_roc_curve': model.area_under_roc_curve,
+        'intra_count': intra_count,
+        'propensities': [{'donor': p.donor_label, 'acceptor': p.acceptor_label, 'propensity': p.propensity,
+                          'is_intermolecular': p.is_intermolecular, 'is_observed': p.is_observed}
+                         for p in propensities],
+        'coordination': coordination,
+        'landscape': [landscape_point(observed_groups, True)] + [landscape_point(group, False) for group in groups],
+    }
 
-    if not noopen:
-        launch_word_processor(output_file)
-    print('Output file written to %s' % output_file)
+
+def screen_structure(task):
+    # Run the HBP calculation for one structure of a batch screen; runs in a worker process, so
+    # returns plain data and captures any failure rather than raising it
+    (index, source, item, csdrefcode, directory, min_donor_coordination, min_acceptor_coordination, fg_count, reports,
+     cache_directory, output_format) = task
+    try:
+        if csdrefcode:
+            crystal = load_crystal(item, True)
+        else:
+            crystal = prepare_crystal(io.CrystalReader(source)[item], '%s:%d' % (source, item))
+        # Identifiers may be repeated or blank, so each structure's files, and its report, are kept in a directory
+        # named with its position in the input
+        work_directory = os.path.join(directory, '%05d_%s' % (index, crystal.identifier))
+        results, coordination_scores = run_calculation(crystal, work_directory, min_donor_coordination,
+                                                       min_acceptor_coordination, fg_count, cache_directory)
+        summary = summarise_results(crystal, results, coordination_scores)
+        if reports:
+            write_report(crystal, crystal.identifier, work_directory, work_directory, results, coordination_scores,
+                         noopen=True, output_format=output_format)
+        return summary
+    except Exception as error:
+        identifier = item if csdrefcode else '%s:%d' % (source, item)
+        print('Propensity calculation failure for %s!' % identifier)
+        return {'identifier': identifier, 'status': 'failure', 'error': str(error)}
+
+
+def write_screen_output(summaries, directory):
+    # Write the consolidated results of a batch screen as JSON, and as CSV tables of propensities,
+    # coordination scores and landscape points
+    with open(os.path.join(directory, '%s.json' % SCREEN_FILENAME), 'w') as outfile:
+        json.dump(summaries, outfile, indent=2)
+
+    successes = [summary for summary in summaries if summary['status'] == 'success']
+
+    with open(os.path.join(directory, '%s_propensities.csv' % SCREEN_FILENAME), 'w', newline='') as outfile:
+        csv_writer = csv.writer(outfile)
+        csv_writer.writerow(['Identifier', 'Donor', 'Acceptor', 'Propensity', 'Intermolecular', 'Observed'])
+        for summary in successes:
+            for p in summary['propensities']:
+                csv_writer.writerow([summary['identifier'], p['donor'], p['acceptor'], p['propensity'],
+                                     p['is_intermolecular'], p['is_observed']])
+
+    with open(os.path.join(directory, '%s_coordination.csv' % SCREEN_FILENAME), 'w', newline='') as outfile:
+        csv_writer = csv.writer(outfile)
+        csv_writer.writerow(['Identifier', 'Label', 'Type', 'Predicted Coordination', 'Coordination Scores'])
+        for summary in successes:
+            for c in summary['coordination']:
+                csv_writer.writerow([summary['identifier'], c['label'], c['type'], c['predicted'],
+                                     '; '.join(str(score) for score in c['scores'])])
+
+    with open(os.path.join(directory, '%s_landscape.csv' % SCREEN_FILENAME), 'w', newline='') as outfile:
+        csv_writer = csv.writer(outfile)
+        csv_writer.writerow(['Identifier', 'Mean Propensity', 'Mean Coordination Score', 'Hydrogen Bond Count',
+                             'Hydrogen Bonds', 'Observed'])
+        for summary in successes:
+            for point in summary['landscape']:
+                csv_writer.writerow([summary['identifier'], point['mean_propensity'], point['mean_coordination'],
+                                     point['hbond_count'], point['hbonds'], point['observed']])
+
+
+def batch_main(source, directory, min_donor_coordination, min_acceptor_coordination, fg_count, processes,
+               reports=False, cache_directory=None, output_format='docx'):
+    # Screen a list of refcodes (a text file with one per line) or every structure in a multi-structure file
+    if os.path.splitext(source)[1].lower() in ('.txt', '.gcd'):
+        with open(source) as infile:
+            items = [line.strip() for line in infile if line.strip()]
+        csdrefcode = True
+    else:
+        items = list(range(len(io.CrystalReader(source))))
+        csdrefcode = False
+
+    if reports and output_format == 'docx':
+        check_docx_requirements()
+
+    tasks = [(index, source, item, csdrefcode, directory, min_donor_coordination, min_acceptor_coordination, fg_count,
+              reports, cache_directory, output_format) for index, item in enumerate(items)]
+
+    print('Screening %d structures on %d processes' % (len(tasks), processes))
+    with multiprocessing.Pool(processes) as pool:
+        summaries = pool.map(screen_structure, tasks, chunksize=1)
+
+    write_screen_output(summaries, directory)
+    failures = [summary['identifier'] for summary in summaries if summary['status'] != 'success']
+    if failures:
+        print('Propensity calculation failed for: %s' % ', '.join(failures))
+    print('Screening output written to %s' % os.path.join(directory, '%s.json' % SCREEN_FILENAME))
 
 
 if __name__ == '__main__':
@@ -494,9 +956,35 @@ if __name__ == '__main__':
                         help='Target functional group count for HBP hits')
     parser.add_argument('-n', '--noopen', action='store_true',
                         help='Do not automatically open the generated output file.')
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Screen every structure in input_structure, either a text file of refcodes '
+                             '(.txt or .gcd, one per line) or a multi-structure file')
+    parser.add_argument('-p', '--processes', default=os.cpu_count(), type=int,
+                        help='Number of processes to use in batch mode')
+    parser.add_argument('-r', '--reports', action='store_true',
+                        help='Also write a report for each structure in batch mode')
+    parser.add_argument('-f', '--output_format', default='docx', choices=['docx', 'json'],
+                        help='Report format: docx, or json to write the report data as JSON with an HTML view '
+                             '(does not need Word or docxtpl)')
+    parser.add_argument('--image_processes', default=IMAGE_PROCESSES, type=int,
+                        help='Number of processes drawing report images while the calculation runs (0 to draw them '
+                             'afterwards in the main process)')
+    parser.add_argument('-k', '--cache_directory', default=None,
+                        help='Directory in which to cache fitting data by functional-group signature, '
+                             'to be reused by structures with the same functional groups')
 
     args = parser.parse_args()
 
+    if args.batch:
+        if not os.path.isfile(args.input_structure):
+            parser.error('%s - file not found.' % args.input_structure)
+        if not os.path.isdir(args.output_directory):
+            os.makedirs(args.output_directory)
+        batch_main(args.input_structure, args.output_directory, args.min_donor_coordination,
+                   args.min_acceptor_coordination, args.fg_count, args.processes, args.reports, args.cache_directory,
+                   args.output_format)
+        sys.exit()
+
     refcode = False
 
     if not os.path.isfile(args.input_structure):
@@ -509,4 +997,5 @@ if __name__ == '__main__':
     elif not os.path.isdir(args.output_directory):
         os.makedirs(args.output_directory)
 
-    main(args.input_structure, args.output_directory, refcode, args.min_donor_coordination, args.min_acceptor_coordination, args.fg_count, args.noopen)
+    main(args.input_structure, args.output_directory, refcode, args.min_donor_coordination, args.min_acceptor_coordination, args.fg_count, args.noopen,
+         args.cache_directory, args.image_processes, args.output_format)
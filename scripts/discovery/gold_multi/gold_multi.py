@@ -11,20 +11,25 @@
 #
 ########################################################################################################################
 
+import csv
+import json
 import logging
+import re
 import sys
+import threading
 from argparse import ArgumentParser
-from dataclasses import dataclass, field
-from multiprocessing import Pool
-from os import chdir, mkdir
+from dataclasses import asdict, dataclass, field
+from multiprocessing import Pool, TimeoutError
+from os import chdir, getpid, mkdir, utime
 from pathlib import Path
-from platform import platform
-from shutil import copy
-from time import time
+from platform import node, platform
+from shutil import copy, move, rmtree
+from time import sleep, time, time_ns
+from typing import Optional
 
 import ccdc
 from ccdc.docking import Docker
-from ccdc.io import EntryReader
+from ccdc.io import EntryReader, EntryWriter
 
 
 # Default GOLD conf file:
@@ -33,15 +38,66 @@ CONF_FILE = 'gold.conf'
 # Default number of parallel processes:
 N_PROCESSES = 6
 
-# Note, although the number of batches is currently the same as the number of processes, it could in theory
-# be greater. One reason to do this might be to ensure that a contiguous block of large, flexible molecules
-# in the input file don't make one batch run much slower than the others. However, there is a cost to starting
-# up new instances of GOLD, so care should be taken with this.
+# Name of the file, written to the output directory, that records the progress of each batch:
+MANIFEST_FILE = 'gold_multi_manifest.json'
+
+# Interval (seconds) at which the coordinator polls the queue directory for completed batches in distributed mode:
+POLL_INTERVAL = 5
+
+# Name of the sub-directory of the output directory to which each worker process writes its progress:
+PROGRESS_DIR = 'progress'
+
+# Name of the file, written to the output directory, that records the aggregated progress of the run:
+STATUS_FILE = 'gold_multi_status.json'
+
+# Interval (seconds) at which workers report progress and the main process logs and writes the status:
+REPORT_INTERVAL = 2
+STATUS_INTERVAL = 60
+
+# Time (seconds) after which a worker that is docking a batch but has not reported progress is considered stalled.
+# Without --interactive, GOLD docks a whole batch in one call, so a worker reports progress from a thread that
+# watches the batch sub-directory every WATCH_INTERVAL seconds, and a batch only stalls if GOLD stops writing to it.
+# In distributed mode, a batch claimed by a stalled worker is returned to the queue for another worker to dock:
+STALL_TIMEOUT = 1800
+WATCH_INTERVAL = 30
+
+# Name of a solution file written by GOLD, from which the index of the ligand docked is taken:
+SOLUTION_FILE_PATTERN = re.compile(r'gold_soln_.*_m(\d+)_\d+\.\w+$')
+
+# Note, by default the number of batches is the same as the number of processes, but it can be made greater
+# with --n_batches. One reason to do this might be to ensure that a contiguous block of large, flexible molecules
+# in the input file don't make one batch run much slower than the others; another is to share the work between
+# workers on several machines in distributed mode. However, there is a cost to starting up new instances of GOLD,
+# so care should be taken with this, unless --interactive is used: each worker process then starts a single
+# interactive GOLD session, reading the settings and preparing the protein once, and docks all its batches in it.
+
+# SD tags holding the fitness score of a pose, by fitness function:
+FITNESS_TAGS = {
+    'plp': 'Gold.PLP.Fitness',
+    'chemscore': 'Gold.Chemscore.Fitness',
+    'goldscore': 'Gold.Goldscore.Fitness',
+    'asp': 'Gold.ASP.Fitness',
+}
 
 # The batching is done such that the sizes are as even as possible.
 # So the last one will not be much shorter than the others.
 # For example, for [1, 2, 3, 4, 5, 6, 7, 8, 9, 10] split into 3 batches, we want
 # [[1, 2, 3, 4], [4, 5, 6], [6, 7, 8, 9]] and not [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]].
+# If the input is filtered before docking (--filter), the batches are instead made as even as possible in their
+# estimated docking cost (see filter_chunk below).
+
+# Defaults for the pre-docking filter:
+MAX_MW = 800.0
+MAX_ROTATABLE_BONDS = 20
+
+# Elements that the pre-docking filter accepts in ligands, broadly those that GOLD's fitness functions are
+# parameterised for; edit as required:
+LIGAND_ELEMENTS = {'H', 'B', 'C', 'N', 'O', 'F', 'Si', 'P', 'S', 'Cl', 'Br', 'I'}
+
+# Names of the files, written to the output directory, holding the output of the pre-docking filter:
+FILTERED_CONF_FILE = 'gold_multi_filtered.conf'
+FILTERED_LIGAND_FILE_STEM = 'gold_multi_filtered'
+REJECTED_FILE = 'gold_multi_rejected.csv'
 
 
 @dataclass
@@ -52,12 +108,66 @@ class Batch:
     finish: int                   # Index of last molecule in batch
     conf_file: Path               # GOLD configuration file
     output_dir: Path              # Output dir, in which the batch sub-directory will be created
+    interactive: bool = False     # Dock in the worker process's interactive GOLD session, see DockingSession below
     dir: Path = field(init=False) # Sub-directory for batch, see __post_init__ below
 
     def __post_init__(self):
         self.dir = self.output_dir / f'batch_{self.n:02d}'
 
 
+@dataclass
+class BatchRecord:
+    """Record type to hold the progress of a batch, as stored in the manifest"""
+    n: int                              # Batch number
+    start: int                          # Index of first molecule in batch
+    finish: int                         # Index of last molecule in batch
+    status: str = 'pending'             # One of 'pending', 'running', 'done' or 'failed'
+    return_code: Optional[int] = None   # GOLD return code (None if GOLD did not run to completion)
+    started: Optional[float] = None     # Time at which docking of the batch started (seconds since the epoch)
+    elapsed: Optional[float] = None     # Time taken to dock the batch (seconds)
+
+
+class Manifest:
+    """
+    The manifest records the range, status, return code and timing of each batch in a JSON file in the output
+    directory. It is only ever written by the main process, and is rewritten each time a batch finishes, so that
+    an interrupted run can be resumed by re-running only those batches that did not complete.
+    """
+
+    def __init__(self, path: Path, conf_file: Path, n_molecules: int, records: list):
+        self.path = path
+        self.conf_file = conf_file
+        self.n_molecules = n_molecules
+        self.records = {record.n: record for record in records}
+
+    @classmethod
+    def load(cls, path: Path) -> 'Manifest':
+        with path.open('r') as file:
+            data = json.load(file)
+        return cls(path, Path(data['conf_file']), data['n_molecules'], [BatchRecord(**x) for x in data['batches']])
+
+    def save(self):
+        data = {
+            'conf_file': str(self.conf_file),
+            'n_molecules': self.n_molecules,
+            'batches': [asdict(record) for record in self.records.values()],
+        }
+        # Write to a temporary file first, so that the manifest is never left half-written
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w') as file:
+            json.dump(data, file, indent=2)
+        tmp_path.replace(self.path)
+
+    def update(self, n: int, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self.records[n], key, value)
+        self.save()
+
+    def unfinished(self) -> list:
+        """Return the records of batches that have not completed successfully"""
+        return [record for record in self.records.values() if record.status != 'done']
+
+
 # A summary of information about the script and where it is running, useful for debugging etc
 SCRIPT_INFO = f"""
 Script:          {sys.argv[0]}
@@ -68,6 +178,607 @@ CSD API version: {ccdc.__version__}
 """
 
 
+@dataclass
+class LigandFilter:
+    """Record type to hold the parameters of the pre-docking filter"""
+    input_file: Path             # Ligand file to filter
+    max_mw: float                # Maximum molecular weight
+    max_rotatable_bonds: int     # Maximum number of rotatable bonds
+
+
+class ResultMerger:
+    """
+    Merges the output of each batch into the output directory as soon as the batch completes. Solution files are
+    moved (not copied) out of the batch sub-directory, and the combined 'bestranking.lst' file, sorted by fitness,
+    is rewritten after every batch, so that a partial ranking is available throughout a long run.
+    """
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        self.preamble_and_header = None
+        self.records = {}  # Batch number -> list of (fitness, line) tuples
+
+    def add(self, batch: Batch):
+        """Merge the output of a completed batch. This is safe to call again for a batch that was already merged."""
+
+        # Move solution files
+        for soln_file in batch.dir.glob('gold_soln_*'):
+            move(str(soln_file), str(self.output_dir / soln_file.name))
+
+        # Load records from 'bestranking.lst' file, fixing file paths as we go
+        with (batch.dir / 'bestranking.lst').open('r') as file:
+            lines = [x.replace(str(batch.dir), str(self.output_dir)).replace('\\.\\', '\\') for x in file.read().split('\n')]
+
+        # The preamble and data header are comment lines; take them from the first batch only
+        n_preamble = 0
+        while n_preamble < len(lines) and (not lines[n_preamble].strip() or lines[n_preamble].startswith('#')):
+            n_preamble += 1
+        if self.preamble_and_header is None:
+            self.preamble_and_header = lines[:n_preamble]
+
+            # Copy over any other required files from the first batch directory (GOLD does not write these in
+            # interactive mode)
+            for file_name in ['gold_protein.mol2']:
+                if (batch.dir / file_name).exists():
+                    copy(str(batch.dir / file_name), self.output_dir)
+
+        # Records, the first field of which is the fitness score
+        self.records[batch.n] = [(float(line.split()[0]), line) for line in lines[n_preamble:] if line.strip()]
+
+        self.write()
+
+    def __len__(self):
+        return sum(len(batch_records) for batch_records in self.records.values())
+
+    def write(self):
+        """Write the combined 'bestranking.lst' file, best fitness first"""
+
+        # Write to a temporary file first, so that a partial ranking can be read at any time
+        tmp_path = self.output_dir / 'bestranking.lst.tmp'
+        with tmp_path.open('w') as file:
+            for line in self.preamble_and_header or []:
+                file.write(f'{line}\n')
+            records = [record for batch_records in self.records.values() for record in batch_records]
+            for _, line in sorted(records, key=lambda x: x[0], reverse=True):
+                file.write(f'{line}\n')
+        tmp_path.replace(self.output_dir / 'bestranking.lst')
+
+
+def worker_id() -> str:
+    """Identify this worker process, in the names of its progress file and of the batches it claims"""
+    return f'{node()}_{getpid()}'
+
+
+class JobQueue:
+    """
+    A queue of batches held as JSON descriptor files in a directory on a shared filesystem, so that workers on any
+    machine that can see the directory can take part in a run. The coordinator writes a descriptor for each batch to
+    the 'pending' sub-directory; a worker claims a batch by renaming its descriptor into the 'claimed' sub-directory,
+    under a name that includes the worker's id and a claim number, which, as a rename is atomic, only one worker can
+    succeed in doing; and on completion, the worker writes the result to the 'done' sub-directory, from which the
+    coordinator collects it. The claim is held as long as the worker reports progress on the batch; if it stops, as
+    when the worker dies, the coordinator returns the batch to the 'pending' sub-directory, and ignores any later
+    result of that claim.
+
+    Paths in the descriptors are absolute, so the shared filesystem must be mounted at the same location on all
+    machines.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.pending_dir = path / 'pending'
+        self.claimed_dir = path / 'claimed'
+        self.done_dir = path / 'done'
+        self.abandoned = set()  # Names of claims returned to the queue by requeue_stale
+        self.claims = {}        # Batch number -> name of the claim, for the batches claimed by this worker
+
+    def create(self, batches: list):
+        """(Re)create the queue, holding the given batches"""
+        for directory in [self.pending_dir, self.claimed_dir, self.done_dir]:
+            if directory.exists():
+                rmtree(directory)
+            directory.mkdir(parents=True)
+
+        for batch in batches:
+            data = {'n': batch.n, 'start': batch.start, 'finish': batch.finish,
+                    'conf_file': str(batch.conf_file), 'output_dir': str(batch.output_dir),
+                    'interactive': batch.interactive}
+            self._write(self.pending_dir / f'batch_{batch.n:02d}.json', data)
+
+    def claim(self) -> Optional[Batch]:
+        """Claim the next pending batch, or return None if there are none left"""
+        for path in sorted(self.pending_dir.glob('*.json')):
+            claimed_path = self.claimed_dir / f'{path.stem}.{worker_id()}.{time_ns()}.json'
+            try:
+                utime(path)  # The claim is held from now
+                path.rename(claimed_path)
+            except FileNotFoundError:
+                continue  # Another worker got there first
+            with claimed_path.open('r') as file:
+                data = json.load(file)
+            self.claims[data['n']] = claimed_path.name
+            return Batch(n=data['n'], start=data['start'], finish=data['finish'],
+                         conf_file=Path(data['conf_file']), output_dir=Path(data['output_dir']),
+                         interactive=data['interactive'])
+        return None
+
+    def complete(self, batch_n: int, return_code: Optional[int], started: float, elapsed: float):
+        """Report the result of a batch claimed by this worker"""
+        name = self.claims.pop(batch_n)
+        data = {'n': batch_n, 'return_code': return_code, 'started': started, 'elapsed': elapsed,
+                'worker': f'{node()}:{getpid()}'}
+        self._write(self.done_dir / name, data)
+        # The claim may have been returned to the queue, or the queue re-created by --resume
+        (self.claimed_dir / name).unlink(missing_ok=True)
+
+    def collect(self) -> list:
+        """Return (and remove from the queue) the results reported since the last call, except those of abandoned
+        claims"""
+        results = []
+        for path in sorted(self.done_dir.glob('*.json')):
+            with path.open('r') as file:
+                data = json.load(file)
+            path.unlink()
+            if path.name not in self.abandoned:
+                results.append((data['n'], data['return_code'], data['started'], data['elapsed']))
+        return results
+
+    def requeue_stale(self, progress_dir: Path, timeout: float) -> list:
+        """
+        Return claimed batches to the queue if the worker that claimed them has reported no progress on them, in its
+        file in the progress directory, for more than timeout seconds since the later of the claim and its last
+        report, and return the batch numbers
+        """
+        now = time()
+        requeued = []
+        for path in sorted(self.claimed_dir.glob('*.json')):
+            name, claim = path.stem.split('.', 1)
+            worker = claim.rsplit('.', 1)[0]
+            try:
+                with path.open('r') as file:
+                    batch_n = json.load(file)['n']
+                last_seen = path.stat().st_mtime
+            except (OSError, ValueError):
+                continue  # Completed, or being claimed; it will be checked next time
+            try:
+                with (progress_dir / f'worker_{worker}.json').open('r') as file:
+                    progress = json.load(file)
+                if progress['batch'] == batch_n:
+                    last_seen = max(last_seen, progress['updated'])
+            except (OSError, ValueError):
+                pass  # No progress reported yet, or being replaced
+            if now - last_seen <= timeout:
+                continue
+            try:
+                path.rename(self.pending_dir / f'{name}.json')
+            except FileNotFoundError:
+                continue  # Completed meanwhile
+            self.abandoned.add(path.name)
+            requeued.append(batch_n)
+        return requeued
+
+    def outstanding(self) -> int:
+        """Return the number of batches pending or claimed"""
+        return len(list(self.pending_dir.glob('*.json'))) + len(list(self.claimed_dir.glob('*.json')))
+
+    @staticmethod
+    def _write(path: Path, data: dict):
+        # Write to a temporary file first, so that a half-written descriptor is never seen by another process
+        tmp_path = path.with_suffix('.tmp')
+        with tmp_path.open('w') as file:
+            json.dump(data, file)
+        tmp_path.replace(path)
+
+
+class ProgressReporter:
+    """
+    Reports the progress of a worker process by rewriting a small JSON file of its own in the progress directory,
+    which, like the queue directory, may be on a filesystem shared between machines. Writes are limited to one
+    every REPORT_INTERVAL seconds, except at the start and end of a batch.
+    """
+
+    # Reporters of this process, by progress directory
+    _reporters = {}
+
+    def __init__(self, progress_dir: Path):
+        progress_dir.mkdir(parents=True, exist_ok=True)
+        self.path = progress_dir / f'worker_{worker_id()}.json'
+        self.data = {
+            'worker': f'{node()}:{getpid()}',
+            'started': time(),   # Time at which the worker started (seconds since the epoch)
+            'updated': time(),   # Time of the latest report
+            'batch': None,       # Number of the batch being docked, if any
+            'n_batches': 0,      # Number of batches finished
+            'n_docked': 0,       # Number of ligands docked
+            'n_failed': 0,       # Number of ligands that failed to dock
+        }
+        self.last_write = 0.0
+        self.n_batch_ligands = 0  # Number of ligands of the current batch reported as docked or failed
+
+    @classmethod
+    def get(cls, progress_dir: Path) -> 'ProgressReporter':
+        """Return this process's reporter for the progress directory, creating it on first use"""
+        if progress_dir not in cls._reporters:
+            cls._reporters[progress_dir] = cls(progress_dir)
+        return cls._reporters[progress_dir]
+
+    def start_batch(self, batch_n: int):
+        self.data['batch'] = batch_n
+        self.n_batch_ligands = 0
+        self.write()
+
+    def add(self, n_docked: int = 0, n_failed: int = 0):
+        self.data['n_docked'] += n_docked
+        self.data['n_failed'] += n_failed
+        self.n_batch_ligands += n_docked + n_failed
+        if time() - self.last_write > REPORT_INTERVAL:
+            self.write()
+
+    def heartbeat(self):
+        """Report that the worker is still making progress, though no ligand has finished"""
+        if time() - self.last_write > REPORT_INTERVAL:
+            self.write()
+
+    def finish_batch(self):
+        self.data['batch'] = None
+        self.data['n_batches'] += 1
+        self.write()
+
+    def write(self):
+        self.data['updated'] = self.last_write = time()
+        tmp_path = self.path.with_suffix('.tmp')
+        with tmp_path.open('w') as file:
+            json.dump(self.data, file)
+        tmp_path.replace(self.path)
+
+
+class BatchWatcher:
+    """
+    Watches the sub-directory of a batch while GOLD docks it non-interactively, from a thread of the worker process.
+    Each ligand for which a solution file appears is reported as docked, and a heartbeat is sent whenever GOLD
+    writes to the directory, so that a long but healthy batch is not reported as stalled.
+    """
+
+    def __init__(self, batch_dir: Path, reporter: ProgressReporter):
+        self.batch_dir = batch_dir
+        self.reporter = reporter
+        self.ligands = set()
+        self.last_modified = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> 'BatchWatcher':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(WATCH_INTERVAL):
+            self.check()
+
+    def check(self):
+        try:
+            paths = list(self.batch_dir.iterdir())
+            last_modified = max((path.stat().st_mtime for path in paths), default=0.0)
+        except OSError:
+            return  # A file was replaced while being read; check again next time
+        ligands = {match.group(1) for match in map(SOLUTION_FILE_PATTERN.match, (path.name for path in paths))
+                   if match}
+        new_ligands = ligands - self.ligands
+        self.ligands |= new_ligands
+        if new_ligands:
+            self.reporter.add(n_docked=len(new_ligands))
+        elif last_modified > self.last_modified:
+            self.reporter.heartbeat()
+        self.last_modified = max(self.last_modified, last_modified)
+
+
+class ProgressMonitor:
+    """
+    Aggregates the progress reported by the workers, logging a status line and writing a machine-readable status
+    file to the output directory every STATUS_INTERVAL seconds, so that throughput can be compared between runs
+    and stalled workers detected.
+    """
+
+    def __init__(self, output_dir: Path, n_molecules: int, settings_summary: dict):
+        self.progress_dir = output_dir / PROGRESS_DIR
+        self.status_path = output_dir / STATUS_FILE
+        self.n_molecules = n_molecules
+        self.settings_summary = settings_summary
+        self.started = time()
+        self.last_report = self.started
+
+        # Clear progress left by the workers of a previous run
+        if self.progress_dir.exists():
+            rmtree(self.progress_dir)
+        self.progress_dir.mkdir()
+
+    def status(self) -> dict:
+        now = time()
+        workers = []
+        for path in sorted(self.progress_dir.glob('*.json')):
+            try:
+                with path.open('r') as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue  # Being replaced; it will be read next time
+            running = now - data['started']
+            data['ligands_per_second'] = data['n_docked'] / running if running > 0 else 0.0
+            data['seconds_since_update'] = now - data['updated']
+            data['stalled'] = data['batch'] is not None and data['seconds_since_update'] > STALL_TIMEOUT
+            workers.append(data)
+
+        n_docked = sum(x['n_docked'] for x in workers)
+        n_failed = sum(x['n_failed'] for x in workers)
+        elapsed = now - self.started
+        rate = n_docked / elapsed if elapsed > 0 else 0.0
+        n_remaining = max(self.n_molecules - n_docked - n_failed, 0)
+
+        return {
+            'updated': now,
+            'elapsed': elapsed,
+            'settings': self.settings_summary,
+            'n_molecules': self.n_molecules,
+            'n_docked': n_docked,
+            'n_failed': n_failed,
+            'ligands_per_second': rate,
+            'eta_seconds': n_remaining / rate if rate > 0 else None,
+            'n_workers': len(workers),
+            'stalled_workers': [x['worker'] for x in workers if x['stalled']],
+            'workers': workers,
+        }
+
+    def report(self, logger: logging.Logger, force: bool = False):
+        """Log a status line and write the status file, if it is time to do so"""
+        if not force and time() - self.last_report < STATUS_INTERVAL:
+            return
+        self.last_report = time()
+
+        status = self.status()
+        tmp_path = self.status_path.with_suffix('.tmp')
+        with tmp_path.open('w') as file:
+            json.dump(status, file, indent=2)
+        tmp_path.replace(self.status_path)
+
+        eta = 'unknown' if status['eta_seconds'] is None else f"{status['eta_seconds'] / 60:.0f} min"
+        logger.info(f"Progress: {status['n_docked']} of {status['n_molecules']} docked, {status['n_failed']} failed; "
+                    f"{status['ligands_per_second']:.2f} ligands/s on {status['n_workers']} workers; ETA {eta}")
+        if status['stalled_workers']:
+            logger.warning(f"Stalled workers: {', '.join(status['stalled_workers'])}")
+
+
+class DockingSession:
+    """
+    An interactive GOLD session, started once per worker process and then used to dock every batch that the
+    process is given. The settings are read and the protein prepared when the session starts, rather than for
+    every batch, so that the input can be split into many small batches cheaply.
+
+    In interactive mode GOLD does not write its usual output, so the session writes a solution file for each pose
+    and a 'bestranking.lst' file for each batch itself, in the same form as GOLD, so that batches can be merged as
+    normal.
+    """
+
+    # Sessions of this process, by configuration file
+    _sessions = {}
+
+    def __init__(self, conf_file: Path, output_dir: Path):
+        settings = Docker.Settings().from_file(str(conf_file))
+
+        # The ligands are given to the session one at a time, so they are read from the input file here
+        ligand_file = settings.ligand_files[0]
+        self.ligand_file_name = ligand_file.file_name
+        self.reader = EntryReader(ligand_file.file_name)
+        self.fitness_tag = FITNESS_TAGS[settings.fitness_function]
+
+        settings.clear_ligand_files()
+        settings.set_hostname(ndocks=ligand_file.ndocks)
+
+        # The session writes its settings to a directory of its own
+        session_dir = output_dir / f'session_{node()}_{getpid()}'
+        session_dir.mkdir(parents=True, exist_ok=True)
+        settings.output_directory = str(session_dir)
+
+        # Keep a reference to the docker, which owns the session
+        self.docker = Docker(settings=settings)
+        self.session = self.docker.dock(str(session_dir / 'settings.conf'), 'interactive')
+
+    @classmethod
+    def get(cls, conf_file: Path, output_dir: Path) -> 'DockingSession':
+        """Return this process's session for the configuration file, starting it on first use"""
+        if conf_file not in cls._sessions:
+            cls._sessions[conf_file] = cls(conf_file, output_dir)
+        return cls._sessions[conf_file]
+
+    def dock_batch(self, batch: Batch, logger: logging.Logger, reporter: ProgressReporter) -> int:
+        """Dock a batch, writing the output to the batch sub-directory; returns 0, like GOLD on success"""
+
+        if batch.dir.exists():
+            rmtree(batch.dir)
+        mkdir(batch.dir)
+
+        logger.info(f"Starting (indices {batch.start} - {batch.finish}, interactive)...")
+
+        stem = Path(self.ligand_file_name).stem
+        records = []
+        n_failed = 0
+
+        # GOLD uses 1-based indexing for molecules
+        for index in range(batch.start, batch.finish + 1):
+            entry = self.reader[index - 1]
+            poses = self.session.dock(entry)
+            if not poses:
+                logger.warning(f"{entry.identifier}: failed to dock")
+                n_failed += 1
+                reporter.add(n_failed=1)
+                continue
+
+            scores = []
+            for n_pose, pose in enumerate(poses, 1):
+                soln_file = batch.dir / f'gold_soln_{stem}_m{index}_{n_pose}.mol2'
+                with EntryWriter(str(soln_file)) as writer:
+                    writer.write(pose)
+                scores.append((float(pose.attributes[self.fitness_tag]), soln_file))
+
+            fitness, soln_file = max(scores, key=lambda x: x[0])
+            records.append(f"{fitness:10.4f}  '{soln_file}' '{entry.identifier}'")
+            reporter.add(n_docked=1)
+
+        with (batch.dir / 'bestranking.lst').open('w') as file:
+            file.write(f'# File generated by {Path(sys.argv[0]).name} (interactive GOLD session)\n')
+            file.write('#\n')
+            file.write(f'#{"Fitness":>10}  File name  Ligand name\n')
+            for record in records:
+                file.write(f'{record}\n')
+
+        logger.info(f"...done ({n_failed} failed to dock)")
+
+        return 0
+
+
+def split_by_cost(costs: list, n_batches: int) -> list:
+
+    """
+    Split molecules into contiguous batches of as near equal total cost as possible.
+
+    :param costs: the estimated cost of docking each molecule, in input order
+    :param n_batches: the number of batches wanted; fewer are returned if there are fewer molecules
+    :returns: a list of (start, finish) tuples of 1-based indices, as GOLD uses 1-based indexing for molecules
+    """
+
+    n_batches = min(n_batches, len(costs))
+    total = sum(costs)
+    ranges = []
+    start = 1
+    cumulative = 0.0
+
+    for index, cost in enumerate(costs, 1):
+        cumulative += cost
+        if len(ranges) == n_batches - 1:
+            break
+        # Close the batch once it has its share of the cost, or if each remaining batch needs the remaining molecules
+        if cumulative >= total * (len(ranges) + 1) / n_batches or len(costs) - index == n_batches - len(ranges) - 1:
+            ranges.append((start, index))
+            start = index + 1
+
+    if costs:
+        ranges.append((start, len(costs)))
+
+    return ranges
+
+
+def filter_chunk(chunk: tuple) -> list:
+
+    """
+    Apply the pre-docking filter to a chunk of the input file.
+
+    :param chunk: a tuple of the filter parameters and the (1-based) indices of the first and last molecules
+    :returns: a list of (index, identifier, SMILES, cost, reason) tuples, where reason is None for accepted
+        molecules and the cost is the estimated relative cost of docking the molecule
+
+    GOLD's search effort grows with the flexibility of a ligand, so the number of rotatable bonds plus one is used
+    as a rough estimate of the relative cost of docking it.
+    """
+
+    ligand_filter, start, finish = chunk
+    results = []
+
+    with EntryReader(str(ligand_filter.input_file)) as reader:
+        for index in range(start, finish + 1):
+            try:
+                molecule = reader[index - 1].molecule
+                identifier = molecule.identifier
+                elements = {atom.atomic_symbol for atom in molecule.atoms}
+                n_rotatable_bonds = sum(1 for bond in molecule.bonds if bond.is_rotatable)
+                molecular_weight = molecule.molecular_weight
+                smiles = molecule.smiles
+            except Exception as e:
+                results.append((index, '', None, 0, f'could not be read ({e})'))
+                continue
+
+            reason = None
+            if elements - LIGAND_ELEMENTS:
+                reason = f"unparameterised element(s) {' '.join(sorted(elements - LIGAND_ELEMENTS))}"
+            elif molecular_weight > ligand_filter.max_mw:
+                reason = f'molecular weight {molecular_weight:.1f} > {ligand_filter.max_mw}'
+            elif n_rotatable_bonds > ligand_filter.max_rotatable_bonds:
+                reason = f'{n_rotatable_bonds} rotatable bonds > {ligand_filter.max_rotatable_bonds}'
+
+            results.append((index, identifier, smiles, 1 + n_rotatable_bonds, reason))
+
+    return results
+
+
+def prefilter(settings: Docker.Settings, ligand_filter: LigandFilter, output_dir: Path, n_processes: int,
+              logger: logging.Logger) -> tuple:
+
+    """
+    Filter and de-duplicate the input file in parallel before docking.
+
+    :param settings: the GOLD settings for the run
+    :param ligand_filter: the filter parameters
+    :param output_dir: the output directory, to which the filtered ligand file, a GOLD configuration file using it,
+        and a report of rejected molecules are written
+    :param n_processes: the number of processes to use
+    :param logger: the logger for the main process
+    :returns: the path of the GOLD configuration file using the filtered ligand file, and the estimated cost of
+        docking each molecule in it
+
+    Molecules with the same canonical SMILES as an earlier molecule in the input file are rejected as duplicates.
+    """
+
+    with EntryReader(str(ligand_filter.input_file)) as reader:
+        n_molecules = len(reader)
+
+    logger.info(f"Filtering {n_molecules} molecules on {n_processes} processes...")
+
+    # Use several chunks per process, so that the processes are kept busy to the end
+    chunks = [(ligand_filter, start, finish) for start, finish in split_by_cost([1] * n_molecules, n_processes * 4)]
+    with Pool(n_processes) as pool:
+        results = [x for chunk_results in pool.map(filter_chunk, chunks) for x in chunk_results]
+
+    # De-duplicate in input order, so that the first of a set of duplicates is kept
+    first_with_smiles = {}
+    accepted, costs, rejected = [], [], []
+    for index, identifier, smiles, cost, reason in results:
+        if reason is None and smiles:
+            if smiles in first_with_smiles:
+                reason = f'duplicate of {first_with_smiles[smiles]}'
+            else:
+                first_with_smiles[smiles] = identifier
+        if reason is None:
+            accepted.append(index)
+            costs.append(cost)
+        else:
+            rejected.append((index, identifier, reason))
+
+    filtered_file = output_dir / f'{FILTERED_LIGAND_FILE_STEM}{ligand_filter.input_file.suffix}'
+    with EntryReader(str(ligand_filter.input_file)) as reader, EntryWriter(str(filtered_file)) as writer:
+        for index in accepted:
+            writer.write(reader[index - 1])
+
+    with (output_dir / REJECTED_FILE).open('w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['index', 'identifier', 'reason'])
+        writer.writerows(rejected)
+
+    logger.info(f"{len(accepted)} molecules accepted for docking, {len(rejected)} rejected "
+                f"(see '{output_dir / REJECTED_FILE}').")
+
+    # Write a configuration file that docks the filtered ligand file; paths are made absolute as it is written to
+    # the output directory
+    ligand_file = settings.ligand_files[0]
+    settings.clear_ligand_files()
+    settings.add_ligand_file(str(filtered_file.resolve()), ndocks=ligand_file.ndocks)
+    settings.output_directory = str(output_dir.resolve())
+    filtered_conf_file = output_dir / FILTERED_CONF_FILE
+    settings.write(str(filtered_conf_file))
+
+    return filtered_conf_file, costs
+
+
 def get_logger(name=__name__):
     logger = logging.getLogger(name)
     handler = logging.StreamHandler()
@@ -77,7 +788,7 @@ def get_logger(name=__name__):
     return logger
 
 
-def do_batch(batch: Batch) -> int:
+def do_batch(batch: Batch) -> tuple:
 
     """
     Dock a batch of the input file.
@@ -85,17 +796,57 @@ def do_batch(batch: Batch) -> int:
     :param batch: a record holding the parameters defining the batch
 
     As we can't return a GOLD results object from a pool process (it can't be pickled as it wraps C++ objects),
-    we simply return a boolean recording whether GOLD exited with a 'success' status code.
+    we simply return the batch number, GOLD's return code and the timing of the batch. The return code is None if
+    docking raised an exception, so that one failing batch does not bring down the whole pool.
     """
 
     logger = get_logger(f"Batch {batch.n}")
 
+    started = time()
+
+    # Paths in the batch are relative to the working directory of the main process, and a pool process may
+    # dock more than one batch, so restore the working directory afterwards
+    cwd = Path.cwd()
+
+    reporter = ProgressReporter.get((batch.output_dir / PROGRESS_DIR).resolve())
+    reporter.start_batch(batch.n)
+
+    try:
+        return_code = _dock_batch(batch, logger, reporter)
+    except Exception as e:
+        logger.error(f"Error! Docking failed: {e}")
+        return_code = None
+    finally:
+        chdir(cwd)
+
+    # Report the ligands that have not been reported already: in interactive mode, progress is reported ligand by
+    # ligand, and otherwise ligands are reported as their solution files appear, but those that were not, or all
+    # those of a batch that raised, are only known from GOLD's overall result
+    n_unreported = batch.finish - batch.start + 1 - reporter.n_batch_ligands
+    if n_unreported > 0:
+        if return_code == 0:
+            reporter.add(n_docked=n_unreported)
+        else:
+            reporter.add(n_failed=n_unreported)
+    reporter.finish_batch()
+
+    return batch.n, return_code, started, time() - started
+
+
+def _dock_batch(batch: Batch, logger: logging.Logger, reporter: ProgressReporter) -> int:
+
+    if batch.interactive:
+        return DockingSession.get(batch.conf_file, batch.output_dir).dock_batch(batch, logger, reporter)
+
     # Settings objects cannot be pickled, so they cannot be passed to pool processes
     # requiring a fresh copy:
     settings = Docker.Settings().from_file(str(batch.conf_file))
 
-    # Create and enter the sub-directory for this batch:
+    # Create and enter the sub-directory for this batch, discarding any partial output from a previous attempt:
+    if batch.dir.exists():
+        rmtree(batch.dir)
     mkdir(batch.dir)
+    batch_dir = batch.dir.resolve()
     chdir(batch.dir)
 
     # Ensure GOLD writes output to the batch sub-directory
@@ -111,13 +862,43 @@ def do_batch(batch: Batch) -> int:
     logger.info(f"Starting (indices {batch.start} - {batch.finish})...")
 
     docker = Docker(settings=settings)
-    results = docker.dock()
+    with BatchWatcher(batch_dir, reporter):
+        results = docker.dock()
 
     logger.info(f"...done")
 
     return results.return_code
 
 
+def run_worker(queue_dir: Path) -> int:
+
+    """
+    Claim and dock batches from the queue in the given directory until none are left.
+
+    :param queue_dir: the queue directory, which may be on a filesystem shared between machines
+    :returns: the number of batches docked
+    """
+
+    queue = JobQueue(queue_dir)
+    n_docked = 0
+
+    while True:
+        batch = queue.claim()
+        if batch is None:
+            break
+        started = time()
+        try:
+            result = do_batch(batch)
+        except BaseException:
+            # Report the claimed batch as failed, so that the coordinator does not wait for it
+            queue.complete(batch.n, None, started, time() - started)
+            raise
+        queue.complete(*result)
+        n_docked += 1
+
+    return n_docked
+
+
 def main():
     """Dock the molecules from the supplied input file in parallel."""
 
@@ -131,20 +912,81 @@ def main():
     )
     parser.add_argument(
         '--n_processes', default=N_PROCESSES, type=int,
-        help=f"No. of processes (default={N_PROCESSES})"
+        help=f"No. of processes (default={N_PROCESSES}); in distributed mode, the no. of local worker processes, "
+             f"which may be zero"
+    )
+    parser.add_argument(
+        '--n_batches', type=int,
+        help="No. of batches to split the input file into (default=no. of processes; required in distributed mode "
+             "with no local worker processes)"
+    )
+    parser.add_argument(
+        '--interactive', action='store_true',
+        help="Dock in one interactive GOLD session per process, rather than starting GOLD for each batch"
+    )
+    parser.add_argument(
+        '--filter', action='store_true',
+        help="Filter and de-duplicate the input file before docking, and balance batches by estimated docking cost"
+    )
+    parser.add_argument(
+        '--max_mw', default=MAX_MW, type=float,
+        help=f"Maximum molecular weight accepted by the filter (default={MAX_MW})"
+    )
+    parser.add_argument(
+        '--max_rotatable_bonds', default=MAX_ROTATABLE_BONDS, type=int,
+        help=f"Maximum no. of rotatable bonds accepted by the filter (default={MAX_ROTATABLE_BONDS})"
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help=f"Resume an interrupted run, re-docking only the batches not recorded as done in '{MANIFEST_FILE}'"
+    )
+    parser.add_argument(
+        '--queue_dir', type=str,
+        help="Distributed mode: share the batches out through a queue in this directory, which must be on a "
+             "filesystem visible to all worker machines"
+    )
+    parser.add_argument(
+        '--worker', action='store_true',
+        help="Run as a worker only, docking batches from the queue given by --queue_dir until none are left "
+             "(the configuration file argument is ignored)"
     )
     config = parser.parse_args()
 
+    n_processes = config.n_processes
+    queue_dir = Path(config.queue_dir).resolve() if config.queue_dir else None
+
+    if config.worker:
+        if queue_dir is None:
+            logger.error("Error! A worker requires a queue directory (--queue_dir).")
+            sys.exit(1)
+        if not n_processes > 0:
+            logger.error("Error! Number of processes must be an integer greater than zero.")
+            sys.exit(1)
+        logger.info(SCRIPT_INFO)
+        with Pool(n_processes) as pool:
+            n_docked = sum(pool.map(run_worker, [queue_dir] * n_processes))
+        logger.info(f"Worker processes docked {n_docked} batches; none are left in the queue.")
+        return
+
     conf_file = Path(config.conf_file)
     if not conf_file.exists():
-        logger.error(f"Error! Configuration file '{conf_file}' not found!", file=sys.stderr)
+        logger.error(f"Error! Configuration file '{conf_file}' not found!")
         sys.exit(1)
 
-    n_processes = config.n_processes
+    if not (n_processes > 0 or (queue_dir is not None and n_processes == 0)):
+        logger.error("Error! Number of processes must be an integer greater than zero.")
+        sys.exit(1)
+
+    # A coordinator with no local worker processes has no number of processes to take the number of batches from
+    if n_processes == 0 and config.n_batches is None and not config.resume:
+        logger.error("Error! A coordinator with no local worker processes (--n_processes 0) requires the number of "
+                     "batches (--n_batches).")
+        sys.exit(1)
 
-    if not n_processes > 0:
-        logger.error(f"Error! Number of processes must be an integer greater than zero.")
+    if config.n_batches is not None and not config.n_batches > 0:
+        logger.error("Error! Number of batches must be an integer greater than zero.")
         sys.exit(1)
+    n_batches = config.n_batches if config.n_batches is not None else n_processes
 
     logger.info(SCRIPT_INFO)
 
@@ -154,69 +996,155 @@ def main():
 
     # Ensure the output directory exists (a sub-directory for each batch is created within)
     output_dir = Path(settings.output_directory)
+    manifest_path = output_dir / MANIFEST_FILE
 
+    if config.resume:
+        if not manifest_path.exists():
+            logger.error(f"Error! No manifest '{manifest_path}' found to resume from.")
+            sys.exit(1)
     # Skip directory (re)creation if output dir is current directory
-    if not str(output_dir) == '.':
+    elif not str(output_dir) == '.':
         if output_dir.exists():
             logger.error(f"Error! Output dir '{output_dir}' already exists.")
             sys.exit(1)
         mkdir(output_dir)
 
-    # Count the molecules to dock in the input file
-    input_file = Path(settings.ligand_files[0].file_name)
+    if config.resume:
+        # Take the batches from the manifest, as the number of processes may differ from the original run, and dock
+        # with the configuration file of the original run, which may be that written by the filter
+        manifest = Manifest.load(manifest_path)
+        conf_file = manifest.conf_file
 
-    with EntryReader(str(input_file)) as reader:
-        n_molecules = len(reader)
-    logger.info(f"There are {n_molecules} molecules to dock on {n_processes} processes...")
+        # Count the molecules to dock in the input file
+        input_file = Path(Docker.Settings().from_file(str(conf_file)).ligand_files[0].file_name)
 
-    # Here we determine the sets of parameters defining the batches; recall that:
-    # 1) We choose the number of batches to be the same as the number of processes.
-    # 2) GOLD uses 1-based indexing for molecules.
+        with EntryReader(str(input_file)) as reader:
+            n_molecules = len(reader)
 
-    basic_size, remainder = n_molecules // n_processes, n_molecules % n_processes
+        if manifest.n_molecules != n_molecules:
+            logger.error(f"Error! Input file now has {n_molecules} molecules, but the manifest records "
+                         f"{manifest.n_molecules}.")
+            sys.exit(1)
+        logger.info(f"Resuming: {len(manifest.unfinished())} of {len(manifest.records)} batches to dock "
+                    f"on {n_processes} processes...")
+    else:
+        input_file = Path(settings.ligand_files[0].file_name)
 
-    batches = []
-    start = 1
+        if config.filter:
+            ligand_filter = LigandFilter(input_file, config.max_mw, config.max_rotatable_bonds)
+            conf_file, costs = prefilter(Docker.Settings().from_file(str(conf_file)), ligand_filter, output_dir,
+                                         max(n_processes, 1), logger)
+        else:
+            # Count the molecules to dock in the input file; without the filter, all are taken to cost the same
+            with EntryReader(str(input_file)) as reader:
+                costs = [1] * len(reader)
 
-    for batch_n in range(1, n_processes+1):
-        finish = start + basic_size + (1 if batch_n <= remainder else 0) - 1
-        batches.append(Batch(n=batch_n, start=start, finish=finish, conf_file=conf_file, output_dir=output_dir))
-        start = finish + 1
+        n_molecules = len(costs)
 
-    # Dock the batches in parallel
-    with Pool(n_processes) as pool:
-        _ = pool.map(do_batch, batches)  # We are not currently checking the return codes
+        logger.info(f"There are {n_molecules} molecules to dock in {n_batches} batches on {n_processes} processes...")
+
+        records = [
+            BatchRecord(n=batch_n, start=start, finish=finish)
+            for batch_n, (start, finish) in enumerate(split_by_cost(costs, n_batches), 1)
+        ]
+
+        manifest = Manifest(manifest_path, conf_file, n_molecules, records)
+        manifest.save()
+
+    # In distributed mode, workers may be running in other directories on other machines, so use absolute paths
+    batch_conf_file, batch_output_dir = (conf_file.resolve(), output_dir.resolve()) if queue_dir else (conf_file, output_dir)
 
-    # Combine output from batches into output directory and write combined 'bestranking.lst' file
-    bestranking = []
-    preamble_and_header = None
+    batches = [
+        Batch(n=record.n, start=record.start, finish=record.finish, conf_file=batch_conf_file, output_dir=batch_output_dir,
+              interactive=config.interactive)
+        for record in manifest.records.values()
+    ]
+    todo = [batch for batch in batches if manifest.records[batch.n].status != 'done']
+
+    for batch in todo:
+        manifest.update(batch.n, status='running', return_code=None, started=None, elapsed=None)
+
+    # Combine output from batches into output directory as each one completes; batches completed in a previous run
+    # are merged first, which picks up anything left over if that run was interrupted while merging
+    merger = ResultMerger(batch_output_dir)
     for batch in batches:
-        # Copy solution files
-        for soln_file in batch.dir.glob('gold_soln_*'):
-            copy(str(soln_file), output_dir)
+        if manifest.records[batch.n].status == 'done':
+            merger.add(batch)
 
-        # Load records from 'bestranking.lst' file, fixing file paths as we go
-        with (batch.dir / 'bestranking.lst').open('r') as file:
-            lines = [x.replace(str(batch.dir), str(output_dir)).replace('\\.\\', '\\') for x in file.read().split('\n')]
+    def handle_result(batch_n, return_code, started, elapsed):
+        """Record a finished batch in the manifest and merge its output"""
+        status = 'done' if return_code == 0 else 'failed'
+        manifest.update(batch_n, status=status, return_code=return_code, started=started, elapsed=elapsed)
+        if status == 'done':
+            merger.add(next(batch for batch in batches if batch.n == batch_n))
+            logger.info(f"Merged batch {batch_n}: {len(merger)} molecules ranked so far.")
+        else:
+            logger.warning(f"Batch {batch_n} failed (return code {return_code}).")
+
+    # Monitor the progress reported by the workers
+    monitor = ProgressMonitor(
+        batch_output_dir, sum(batch.finish - batch.start + 1 for batch in todo),
+        {'fitness_function': settings.fitness_function, 'autoscale': settings.autoscale,
+         'n_batches': len(batches), 'interactive': config.interactive}
+    )
 
-        # Take preamble and data header from first batch only
-        if batch.n == 1:
-            preamble_and_header = lines[:7]
+    if queue_dir is None:
+        # Dock the batches in parallel, handling each as it finishes
+        with Pool(n_processes) as pool:
+            results = pool.imap_unordered(do_batch, todo)
+            n_reported = 0
+            while n_reported < len(todo):
+                try:
+                    result = results.next(timeout=POLL_INTERVAL)
+                except TimeoutError:
+                    monitor.report(logger)
+                    continue
+                handle_result(*result)
+                n_reported += 1
+    else:
+        # Put the batches on the queue, start any local workers, then collect results as workers on any machine
+        # report them, until all batches are accounted for
+        queue = JobQueue(queue_dir)
+        queue.create(todo)
+        logger.info(f"Queued {len(todo)} batches in '{queue_dir}'; start workers with: "
+                    f"{Path(sys.argv[0]).name} --worker --queue_dir {queue_dir}")
 
-        bestranking.extend(lines[7:-1])  # Records
+        # Note, a remote worker that dies while docking stops reporting progress, so after STALL_TIMEOUT seconds its
+        # batch is re-queued for another worker. A local worker that fails reports its claimed batch as failed, and
+        # the coordinator stops waiting
+        progress_dir = batch_output_dir / PROGRESS_DIR
+        with Pool(max(n_processes, 1)) as pool:
+            local_workers = pool.map_async(run_worker, [queue_dir] * n_processes)
+            n_reported = 0
+            while n_reported < len(todo):
+                results = queue.collect()
+                for result in results:
+                    handle_result(*result)
+                n_reported += len(results)
+                if local_workers.ready() and not local_workers.successful():
+                    try:
+                        local_workers.get()
+                    except Exception as e:
+                        logger.error(f"Error! A local worker process failed: {e}")
+                    break
+                if not results:
+                    for batch_n in queue.requeue_stale(progress_dir, STALL_TIMEOUT):
+                        logger.warning(f"Batch {batch_n} re-queued: its worker has reported no progress for "
+                                       f"{STALL_TIMEOUT} seconds.")
+                    monitor.report(logger)
+                    sleep(POLL_INTERVAL)
 
-    # Write 'bestranking.lst' file
-    with open(output_dir / 'bestranking.lst', 'w') as file:
-        file.write(f'\n{preamble_and_header}\n')    # Preamble and data header
-        file.write(f'\n{bestranking}\n')            # Records
+    monitor.report(logger, force=True)
 
-    # Copy over any other required files from first batch directory
-    batch_dir = batches[0].dir
-    for file_name in ['gold_protein.mol2']:
-        copy(str(batch_dir / file_name), output_dir)
+    failed = manifest.unfinished()
 
     logger.info(f"Finished in {time() - t0:.1f} seconds.")
 
+    if failed:
+        logger.error(f"Error! {len(failed)} batch(es) did not complete: {', '.join(str(x.n) for x in failed)}. "
+                     f"Re-run with --resume to re-dock them.")
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from dataclasses import asdict
+from pathlib import Path
+from time import time
+from types import SimpleNamespace
+from unittest import mock
+
+import gold_multi
+from gold_multi import MANIFEST_FILE, BatchRecord, JobQueue, Manifest, ProgressReporter, split_by_cost
+
+
+class TestSplitByCost(unittest.TestCase):
+
+    def assertContiguous(self, ranges, n_molecules):
+        """The ranges cover molecules 1 to n_molecules in order, with no gaps or overlaps."""
+        self.assertEqual([index for start, finish in ranges for index in range(start, finish + 1)],
+                         list(range(1, n_molecules + 1)))
+
+    def test_equal_costs(self):
+
+        # As in the example at the top of gold_multi.py, the last batch is not much shorter than the others
+        self.assertEqual(split_by_cost([1] * 10, 3), [(1, 4), (5, 7), (8, 10)])
+        self.assertEqual(split_by_cost([1] * 10, 1), [(1, 10)])
+
+    def test_fewer_molecules_than_batches(self):
+
+        self.assertEqual(split_by_cost([1] * 3, 5), [(1, 1), (2, 2), (3, 3)])
+        self.assertEqual(split_by_cost([], 3), [])
+
+    def test_expensive_molecules(self):
+
+        self.assertEqual(split_by_cost([10] + [1] * 10, 2), [(1, 1), (2, 11)])
+        self.assertEqual(split_by_cost([1] * 4 + [10], 2), [(1, 4), (5, 5)])
+
+    def test_random_costs(self):
+
+        rng = random.Random(1)
+        for _ in range(200):
+            costs = [rng.uniform(0.1, 10.0) for _ in range(rng.randint(1, 60))]
+            n_batches = rng.randint(1, 12)
+
+            ranges = split_by_cost(costs, n_batches)
+
+            self.assertEqual(len(ranges), min(n_batches, len(costs)))
+            self.assertContiguous(ranges, len(costs))
+            # No batch takes more than its share of the cost plus that of one molecule
+            share = sum(costs) / len(ranges)
+            for start, finish in ranges:
+                self.assertLessEqual(sum(costs[start - 1:finish]), share + max(costs) + 1e-9)
+
+
+def fake_do_batch(batch):
+    """Stands in for do_batch, writing the output GOLD would for a batch, with one solution per ligand."""
+    batch.dir.mkdir(exist_ok=True)
+    (batch.dir / 'docked').write_text('')
+    lines = ['# GOLD bestranking', '#  Fitness  File']
+    for index in range(batch.start, batch.finish + 1):
+        solution_file = batch.dir / f'gold_soln_input_m{index}_1.sdf'
+        solution_file.write_text('')
+        lines.append(f'{float(index):8.2f}  {solution_file}')
+    (batch.dir / 'bestranking.lst').write_text('\n'.join(lines) + '\n')
+    return batch.n, 0, time(), 0.0
+
+
+class FakeEntryReader:
+    """Stands in for an EntryReader of the input file, which has eight molecules."""
+
+    def __init__(self, file_name):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __len__(self):
+        return 8
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = Path(tempfile.mkdtemp())
+        self.output_dir = self.directory / 'output'
+        self.output_dir.mkdir()
+        self.conf_file = self.directory / 'gold.conf'
+        self.conf_file.write_text('')
+
+        # A run that was interrupted: batches 1 and 3 are done, batch 2 failed, and batch 4 was still running
+        statuses = {1: 'done', 2: 'failed', 3: 'done', 4: 'running'}
+        records = [BatchRecord(n=n, start=2 * n - 1, finish=2 * n, status=status,
+                               return_code=0 if status == 'done' else None)
+                   for n, status in statuses.items()]
+        Manifest(self.output_dir / MANIFEST_FILE, self.conf_file, 8, records).save()
+        for n, status in statuses.items():
+            if status == 'done':
+                batch = gold_multi.Batch(n=n, start=2 * n - 1, finish=2 * n, conf_file=self.conf_file,
+                                         output_dir=self.output_dir)
+                fake_do_batch(batch)
+                (batch.dir / 'docked').unlink()
+        # Batch 1 was merged before the interruption, so its solution files were moved to the output directory
+        for solution_file in (self.output_dir / 'batch_01').glob('gold_soln_*'):
+            solution_file.rename(self.output_dir / solution_file.name)
+
+        settings = SimpleNamespace(output_directory=str(self.output_dir),
+                                   ligand_files=[SimpleNamespace(file_name='input.sdf')],
+                                   fitness_function='plp', autoscale=1.0)
+        docker = mock.MagicMock()
+        docker.Settings.return_value.from_file.return_value = settings
+        self.patches = [mock.patch.object(gold_multi, 'Docker', docker),
+                        mock.patch.object(gold_multi, 'EntryReader', FakeEntryReader),
+                        mock.patch.object(gold_multi, 'do_batch', fake_do_batch)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.directory)
+
+    def test_resume_redocks_unfinished_batches(self):
+
+        with mock.patch.object(sys, 'argv', ['gold_multi.py', str(self.conf_file), '--resume', '--n_processes', '2']):
+            gold_multi.main()
+
+        redocked = sorted(int(path.parent.name.split('_')[1]) for path in self.output_dir.glob('batch_*/docked'))
+        self.assertEqual(redocked, [2, 4])
+
+        manifest = Manifest.load(self.output_dir / MANIFEST_FILE)
+        self.assertEqual([record.status for record in manifest.records.values()], ['done'] * 4)
+        self.assertEqual([record.return_code for record in manifest.records.values()], [0] * 4)
+
+        # The ranking is rebuilt from all the batches, best first, and every solution file is in the output directory
+        lines = (self.output_dir / 'bestranking.lst').read_text().splitlines()
+        self.assertEqual(lines[:2], ['# GOLD bestranking', '#  Fitness  File'])
+        self.assertEqual([float(line.split()[0]) for line in lines[2:]], [8.0, 7.0, 6.0, 5.0, 4.0, 3.0, 2.0, 1.0])
+        for line in lines[2:]:
+            self.assertEqual(Path(line.split()[1]).parent, self.output_dir)
+        self.assertEqual(len(list(self.output_dir.glob('gold_soln_*'))), 8)
+
+    def test_manifest_round_trip(self):
+
+        manifest = Manifest.load(self.output_dir / MANIFEST_FILE)
+
+        self.assertEqual(manifest.conf_file, self.conf_file)
+        self.assertEqual(manifest.n_molecules, 8)
+        self.assertEqual([record.n for record in manifest.unfinished()], [2, 4])
+        with (self.output_dir / MANIFEST_FILE).open() as file:
+            self.assertEqual(json.load(file)['batches'][1], asdict(manifest.records[2]))
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+
+        self.directory = Path(tempfile.mkdtemp())
+        self.progress_dir = self.directory / 'progress'
+        self.queue = JobQueue(self.directory / 'queue')
+        self.queue.create([gold_multi.Batch(n=n, start=n, finish=n, conf_file=self.directory / 'gold.conf',
+                                            output_dir=self.directory) for n in (1, 2)])
+
+    def tearDown(self):
+
+        shutil.rmtree(self.directory)
+
+    def age_claims(self, seconds):
+        """Make the claims look as if they were made the given number of seconds ago."""
+        for path in self.queue.claimed_dir.glob('*.json'):
+            os.utime(path, (time() - seconds, time() - seconds))
+
+    def test_claim_and_complete(self):
+
+        batch = self.queue.claim()
+        self.assertEqual(batch.n, 1)
+        self.assertEqual(self.queue.outstanding(), 2)
+
+        self.queue.complete(batch.n, 0, time(), 1.0)
+
+        self.assertEqual(self.queue.outstanding(), 1)
+        self.assertEqual([result[:2] for result in self.queue.collect()], [(1, 0)])
+        self.assertEqual(self.queue.collect(), [])
+
+    def test_stale_claim_is_requeued(self):
+
+        batch = self.queue.claim()
+        self.age_claims(100)
+
+        # A worker that claimed the batch but has reported nothing since is taken to have died
+        self.assertEqual(self.queue.requeue_stale(self.progress_dir, 50), [1])
+        self.assertEqual(sorted(path.name for path in self.queue.pending_dir.glob('*.json')),
+                         ['batch_01.json', 'batch_02.json'])
+
+        # If the worker was only slow, its result is ignored, and that of the worker that claims the batch next is not
+        self.queue.complete(batch.n, 0, time(), 1.0)
+        self.assertEqual(self.queue.collect(), [])
+        batch = self.queue.claim()
+        self.queue.complete(batch.n, 0, time(), 1.0)
+        self.assertEqual([result[:2] for result in self.queue.collect()], [(1, 0)])
+
+    def test_claim_with_progress_is_kept(self):
+
+        batch = self.queue.claim()
+        self.age_claims(100)
+        ProgressReporter(self.progress_dir).start_batch(batch.n)
+
+        self.assertEqual(self.queue.requeue_stale(self.progress_dir, 50), [])
+        self.assertEqual(len(list(self.queue.claimed_dir.glob('*.json'))), 1)
+
+    def test_recent_claim_is_kept(self):
+
+        self.queue.claim()
+
+        self.assertEqual(self.queue.requeue_stale(self.progress_dir, 50), [])
+
+
+class TestArguments(unittest.TestCase):
+
+    def test_zero_batches_rejected(self):
+
+        with tempfile.TemporaryDirectory() as directory:
+            conf_file = Path(directory) / 'gold.conf'
+            conf_file.write_text('')
+            for n_batches in ('0', '-1'):
+                with mock.patch.object(sys, 'argv', ['gold_multi.py', str(conf_file), '--n_batches', n_batches]):
+                    with self.assertRaises(SystemExit) as context:
+                        gold_multi.main()
+                self.assertEqual(context.exception.code, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
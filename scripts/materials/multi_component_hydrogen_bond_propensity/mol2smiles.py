@@ -11,6 +11,7 @@ from ccdc.io import MoleculeReader
 import os
 import csv
 import argparse
+import multiprocessing
 from utilities import file_list, string_scrubber, read_experimental_csv
 
 
@@ -22,6 +23,21 @@ def read_mol_file(directory, file):
     return mol.identifier, mol.heaviest_component.smiles
 
 
+def read_mol_path(path):
+    return read_mol_file(*os.path.split(path))
+
+
+def read_mol_files(paths, processes):
+    '''Returns: {path: (identifier, smiles)}, reading each file once, in parallel'''
+    paths = sorted(set(paths))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(read_mol_path, paths, chunksize=max(1, len(paths) // (4 * processes)))
+    else:
+        results = [read_mol_path(path) for path in paths]
+    return dict(zip(paths, results))
+
+
 def main():
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument(
@@ -47,6 +63,12 @@ def main():
         action='store_true',
         help='Removes special characters from ids that may be problematic.'
     )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of processes used to read the molecule files.'
+    )
     
     args = parser.parse_args()
 
@@ -56,52 +78,59 @@ def main():
         csvwriter.writerow(['identifier', 'n_components',
                            'component_a', 'component_b', 'neutral_a', 'neutral_b'])
     
-    if args.experimental_csv:
-        experimental_dict = read_experimental_csv(args.experimental_csv)
+    experimental_dict = read_experimental_csv(args.experimental_csv) if args.experimental_csv else {}
 
     # API group directories contain one or more API files and a directory of coformers
     API_groups = [name for name in os.listdir(
         args.input_dir) if os.path.isdir(os.path.join(args.input_dir, name))]
-    
+
+    # Read the API and coformer files of all groups up front, once per file
+    group_files = {}
+    for API_group in API_groups:
+        API_group_path = os.path.join(args.input_dir, API_group)
+        coformer_dir_path = os.path.join(API_group_path, 'coformers')
+        group_files[API_group] = (
+            [os.path.join(API_group_path, f) for f in file_list(API_group_path)],
+            [os.path.join(coformer_dir_path, f) for f in file_list(coformer_dir_path)])
+    molecules = read_mol_files([path for api_paths, coformer_paths in group_files.values()
+                                for path in api_paths + coformer_paths], args.processes)
+
     exp_replaced = combo_count = 0
-    
+
     with open(output_path, 'a+', newline='', encoding="utf-8") as output_file:
-        
+        csvwriter = csv.writer(output_file, delimiter=',', quotechar='|')
+
         for API_group in API_groups:
-            csvwriter = csv.writer(output_file, delimiter=',', quotechar='|')
-            API_group_path = os.path.join(args.input_dir, API_group)
-            
-            for API_file in file_list(API_group_path):
-                api_id, api_smiles = read_mol_file(
-                    API_group_path, API_file)
+            api_paths, coformer_paths = group_files[API_group]
+
+            for api_path in api_paths:
+                api_id, api_smiles = molecules[api_path]
                 print(api_id)
-                coformer_dir_path = os.path.join(API_group_path, 'coformers')
-                
-                for coformer_file in file_list(coformer_dir_path):
-                    coformer_id, coformer_smiles = read_mol_file(
-                        coformer_dir_path, coformer_file)
-                    
+
+                for coformer_path in coformer_paths:
+                    coformer_id, coformer_smiles = molecules[coformer_path]
+
                     combo_count += 1
                     exp_bool = "?"
                     # Try to look up the experimental boolean in dictionary, if provided
-                    if args.experimental_csv:
-                        for (x, y) in [(api_id, coformer_id), (coformer_id, api_id)]:
-                            if (x, y) in list(experimental_dict.keys()):
-                                exp_bool = experimental_dict[(x, y)]
-                                exp_replaced += 1
-                    
+                    for key in [(api_id, coformer_id), (coformer_id, api_id)]:
+                        if key in experimental_dict:
+                            exp_bool = experimental_dict[key]
+                            exp_replaced += 1
+
                     # Clean the ids if the option is turned on
                     if args.clean_id:
-                        api_id = string_scrubber(api_id)
-                        coformer_id = string_scrubber(coformer_id)
-                    
+                        combo_ids = [string_scrubber(api_id), string_scrubber(coformer_id)]
+                    else:
+                        combo_ids = [api_id, coformer_id]
+
                     n_components = 2
                     if api_smiles == coformer_smiles:
                         n_components = 1
-                    
-                    combo_id = ".".join([api_id, coformer_id, str(exp_bool)])
+
+                    combo_id = ".".join(combo_ids + [str(exp_bool)])
                     csvwriter.writerow([f'"{combo_id}"', n_components, api_smiles, coformer_smiles, "", ""])
-    
+
     if args.experimental_csv:
         print(f"Found experimental labels for {exp_replaced} out of {combo_count} combinations")
 
@@ -13,24 +13,41 @@
 """
 multi_component_hydrogen_bond_propensity_report.py
  - Performs a multi-component HBP calculation for a given library of co-formers
+ - With --processes, screens the co-formers in parallel
+ - Writes the ranked results as CSV (and optionally Parquet) alongside the summary report
 """
 
 import sys
 import os
 import glob
 import argparse
-import tempfile
 import subprocess
 import json
+import hashlib
+import sqlite3
+import csv
+import multiprocessing
 
+import numpy as np
 import matplotlib
 
-matplotlib.use('TkAgg')
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 from ccdc import io, molecule
+from ccdc.crystal import Crystal
 from ccdc.diagram import DiagramGenerator
 from ccdc.descriptors import CrystalDescriptors
+from ccdc.search import SubstructureSearch, ConnserSubstructure
+
+# Stored fitting data is restored with the helper shared with the HBP report script; without it, every pair is
+# matched against the CSD
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'core',
+                             'hydrogen_bond_propensity'))
+try:
+    from fitting_data import restore_fitting_data
+except ImportError:
+    restore_fitting_data = None
 
 try:
     import warnings
@@ -52,15 +69,129 @@ TEMPLATE_FILENAME = 'multi_component_hydrogen_bond_propensity_report.docx'
 TEMPLATE_FILE = os.path.join(SCRIPT_DIR, TEMPLATE_FILENAME)
 PAIR_TEMPLATE_FILENAME = 'multi_component_pair_hbp_report.docx'
 PAIR_TEMPLATE_FILE = os.path.join(SCRIPT_DIR, PAIR_TEMPLATE_FILENAME)
+FITTING_DATA_DIRNAME = 'fitting_data'
+FITTING_DATA_COUNT = 500  # set to 500 for better representation of functional groups
+RESULT_CACHE_FILENAME = 'mc_hbp_cache.sqlite'
+# Table of the propensities of all pairs, from which the multi-component scores are calculated
+PROPENSITY_DTYPE = np.dtype([('pair', int), ('donor', 'U1'), ('acceptor', 'U1'), ('intermolecular', bool),
+                             ('propensity', float)])
+# Donor:acceptor component combinations, in the order used to pick the top interaction
+MC_INTERACTIONS = [('A', 'A'), ('B', 'B'), ('A', 'B'), ('B', 'A')]
+SCREEN_COLUMNS = ['Rank', 'Coformer', 'Pair', 'Multi-Component Score', 'Top Interaction',
+                  'Max Heteromeric Propensity', 'Max A:A Propensity', 'Max B:B Propensity']
 
 
 ###############################################################################
+class FittingDataStore:
+    """Fitting data found for each functional group, shared by all the pairs of a screen.
+
+    The API's functional groups are in every pair, and co-formers in a library have many groups in common,
+    so the refcodes of the CSD structures matched for each group are kept, one JSON file per group. A pair
+    whose groups have all been seen before is fitted against the union of their subsets, without searching
+    the CSD. Worker processes share the store through its directory.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _file(self, identifier):
+        # Subsets depend on the number of structures matched per group and on the CSD release
+        key = hashlib.sha256(json.dumps([identifier, FITTING_DATA_COUNT, io.csd_version()]).encode()).hexdigest()
+        return os.path.join(self.directory, '%s.json' % key)
+
+    def get(self, identifier):
+        try:
+            with open(self._file(identifier)) as infile:
+                return json.load(infile)['refcodes']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, identifier, refcodes):
+        # Write to a temporary file first, so that a half-written subset is never read
+        fname = self._file(identifier)
+        with open('%s.%d.tmp' % (fname, os.getpid()), 'w') as outfile:
+            json.dump({'functional_group': identifier, 'refcodes': refcodes}, outfile)
+        os.replace('%s.%d.tmp' % (fname, os.getpid()), fname)
+
+    def refcodes(self, functional_groups):
+        # The training set for a pair, or None if any of its groups has not been seen before
+        refcodes = []
+        for fg in functional_groups:
+            subset = self.get(fg.identifier)
+            if subset is None:
+                return None
+            refcodes.extend(subset)
+        return sorted(set(refcodes))
+
+    def add(self, functional_groups, fitting_data, directory):
+        # Split newly matched fitting data into the subsets of the groups not yet in the store, by searching
+        # it for the substructure of each group written to the working directory
+        for fg in functional_groups:
+            if self.get(fg.identifier) is not None:
+                continue
+            con_file = os.path.join(directory, '%s.con' % fg.identifier)
+            if not os.path.isfile(con_file):
+                print('Warning! No substructure file %s for functional group %s, so its fitting data is not stored'
+                      % (con_file, fg.identifier))
+                continue
+            searcher = SubstructureSearch()
+            searcher.add_substructure(ConnserSubstructure(con_file))
+            hits = searcher.search(list(fitting_data))
+            self.put(fg.identifier, sorted(set(hit.identifier for hit in hits)))
+
+
+class ResultCache:
+    """Content-addressed cache of the propensities of api/coformer pairs.
+
+    Results are keyed by hashes of both molecules, the HBP settings and the CSD version, so a changed co-former
+    file or setting is never matched to an old result, while the same pair screened again, from any working
+    directory or for any API name, is. The propensities are stored rather than the scores, so the same results
+    serve rankings with and without --ignore_intra. Results are kept in one indexed SQLite file, which is only
+    read and written by the main process.
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pair_results '
+                                '(key TEXT PRIMARY KEY, api_hash TEXT, coformer_hash TEXT, signature TEXT, '
+                                'result TEXT)')
+        self.connection.commit()
+
+    @staticmethod
+    def key(api_hash, coformer_hash):
+        settings = PropensityCalc._hbp_settings()
+        signature = {
+            'api': api_hash,
+            'coformer': coformer_hash,
+            'fg_count': FITTING_DATA_COUNT,
+            'require_hydrogens': settings.hbond_criterion.require_hydrogens,
+            'path_length_range': list(settings.hbond_criterion.path_length_range),
+            'result': 'propensities',
+            'csd_version': io.csd_version(),
+        }
+        return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest(), signature
+
+    def get(self, key):
+        row = self.connection.execute('SELECT result FROM pair_results WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, key, signature, result):
+        self.connection.execute('INSERT OR REPLACE INTO pair_results VALUES (?, ?, ?, ?, ?)',
+                                (key, signature['api'], signature['coformer'], json.dumps(signature),
+                                 json.dumps(result)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
 class PropensityCalc:
     "HBP Calculator"
-    def __init__(self):
+    def __init__(self, store=None):
         self.crystal = None
         self.directory = None
         self.fg_count = None
+        self.store = store
         self.settings = self._hbp_settings()
         self.hbp = CrystalDescriptors.HBondPropensities()
 
@@ -80,8 +211,12 @@ class PropensityCalc:
         self.hbp.set_target(self.crystal)
         print(self.hbp.functional_groups)
 
-        # Generate Training Dataset
-        self.hbp.match_fitting_data(count=500)  # set to 500 for better representation of functional groups
+        # Generate Training Dataset, from the shared store if all the functional groups have been seen before
+        refcodes = self.store.refcodes(self.hbp.functional_groups) if self.store is not None else None
+        if refcodes is None or not restore_fitting_data(self.hbp, refcodes, 'stored'):
+            self.hbp.match_fitting_data(count=FITTING_DATA_COUNT)
+            if self.store is not None:
+                self.store.add(self.hbp.functional_groups, self.hbp.fitting_data, self.directory)
 
         self.hbp.analyse_fitting_data()
 
@@ -135,11 +270,11 @@ def make_diagram(mol, directory):
     return fname
 
 
-def make_mc_chart(dictionary, directory, mol):
-    results = [value[0] for key, value in dictionary if isinstance(value[0], float)]
-    ymin = min(results)
-    ymax = max(results)
-    indices = range(1, len(results) + 1)
+def make_mc_chart(results, directory, mol):
+    # Plots the multi-component scores of the successful pairs, in rank order
+    ymin = results.min()
+    ymax = results.max()
+    indices = np.arange(1, len(results) + 1)
 
     fig = plt.figure(figsize=cm2inch(22, 18))
     ax = fig.add_subplot(1, 1, 1)
@@ -157,6 +292,7 @@ def make_mc_chart(dictionary, directory, mol):
     plt.ylim(ymin - 0.025, ymax + 0.025)
     fname = str(os.path.join(directory, '%s_MC_HBP_plot.png' % mol.identifier))
     plt.savefig(fname, format='png', dpi=600)
+    plt.close(fig)
     return fname
 
 
@@ -190,60 +326,72 @@ def format_scores(scores, das, d_type):
     return formatted_scores
 
 
-def get_mc_scores(propensities, identifier, ignore_intra:bool):
-    # Calculates the multi-component scores from the individual HBP calculation
-    AA_propensities = []
-    BB_propensities = []
-    AB_propensities = []
-    BA_propensities = []
-    AA_intra_propensities = []
-    BB_intra_propensities = []
+def label_component(label):
+    # The component, A (api) or B (coformer), of a donor or acceptor from its label
+    label = '%s_' % label.split(" ")[0]
+    return 'A' if '_A_' in label else 'B' if '_B_' in label else ''
 
-    for p in propensities:
-        if ignore_intra and not p.is_intermolecular:
-            continue
-        t = "%s_d" % p.donor_label.split(" ")[0], "%s_a" % p.acceptor_label.split(" ")[0]
-        if '_A_' in t[0] and '_A_' in t[1]:
-            AA_propensities.append(p.propensity)
-            if not p.is_intermolecular:
-                AA_intra_propensities.append(p.propensity)
-        elif '_B_' in t[0] and '_B_' in t[1]:
-            BB_propensities.append(p.propensity)
-            if not p.is_intermolecular:
-                BB_intra_propensities.append(p.propensity)
-        elif '_A_' in t[0] and '_B_' in t[1]:
-            AB_propensities.append(p.propensity)
-        elif '_B_' in t[0] and '_A_' in t[1]:
-            BA_propensities.append(p.propensity)
-    max_AA = max(AA_propensities) if len(AA_propensities) > 0 else 0.0
-    max_BB = max(BB_propensities) if len(BB_propensities) > 0 else 0.0
-    max_AB = max(AB_propensities) if len(AB_propensities) > 0 else 0.0
-    max_BA = max(BA_propensities) if len(BA_propensities) > 0 else 0.0
-    max_list = [max_AA, max_BB, max_AB, max_BA]
-    max_mc = max(max_list[2], max_list[3])
-    max_sc = max(max_list[0], max_list[1])
-
-    max_keys = ['A:A*', 'B:B*', 'A:B', 'B:A'] if max_sc in AA_intra_propensities or max_sc in BB_intra_propensities \
-        else ['A:A', 'B:B', 'A:B', 'B:A']
-
-    return [round((max_mc - max_sc), 2),
-            max_keys[max_list.index(max(max_list))],
-            round(max_mc, 2),
-            round(max_list[0], 2),
-            round(max_list[1], 2),
-            identifier]
-
-
-def make_pair_file(api_molecule, tempdir, f):
-    # Creates a file for the api/coformer pair
-    with io.MoleculeReader(f) as reader:
-        coformer_molecule = reader[0]
-        coformer_name = coformer_molecule.identifier
-        molecule_pair = make_molecule_pair(api_molecule, coformer_molecule)
-        molecule_file = os.path.join(tempdir, '%s.mol2' % molecule_pair.identifier)
-        with io.MoleculeWriter(molecule_file) as writer:
-            writer.write(molecule_pair)
-    return molecule_file, coformer_name
+
+def propensity_records(propensities):
+    # The donor and acceptor components, intermolecular flag and propensity of each propensity of a pair
+    return [(label_component(p.donor_label), label_component(p.acceptor_label), p.is_intermolecular, p.propensity)
+            for p in propensities]
+
+
+def propensity_table(pair_records):
+    # Collects the propensity records of all pairs into one table, numbering the pairs in order
+    return np.array([(pair,) + tuple(record) for pair, records in enumerate(pair_records) for record in records],
+                    dtype=PROPENSITY_DTYPE)
+
+
+def get_mc_scores(table, identifiers, ignore_intra:bool):
+    # Calculates the multi-component scores of all pairs from the table of their propensities
+    if ignore_intra:
+        table = table[table['intermolecular']]
+
+    # Maximum propensity of each interaction (A:A, B:B, A:B, B:A) for each pair, 0.0 if there is none
+    interaction = np.full(len(table), -1)
+    for i, (donor, acceptor) in enumerate(MC_INTERACTIONS):
+        interaction[(table['donor'] == donor) & (table['acceptor'] == acceptor)] = i
+    table, interaction = table[interaction >= 0], interaction[interaction >= 0]
+    maxima = np.full((len(MC_INTERACTIONS), len(identifiers)), -np.inf)
+    np.maximum.at(maxima, (interaction, table['pair']), table['propensity'])
+    maxima[np.isinf(maxima)] = 0.0
+
+    max_mc = maxima[2:].max(axis=0)
+    max_sc = maxima[:2].max(axis=0)
+
+    # The top single-component interaction is starred if it is intramolecular
+    intra = table[(interaction < 2) & ~table['intermolecular']]
+    starred = np.zeros(len(identifiers), dtype=bool)
+    starred[intra['pair'][intra['propensity'] == max_sc[intra['pair']]]] = True
+    top = maxima.argmax(axis=0)
+
+    max_keys = ['A:A', 'B:B', 'A:B', 'B:A']
+    starred_keys = ['A:A*', 'B:B*', 'A:B', 'B:A']
+    return [[round(float(max_mc[i] - max_sc[i]), 2),
+             (starred_keys if starred[i] else max_keys)[top[i]],
+             round(float(max_mc[i]), 2),
+             round(float(maxima[0, i]), 2),
+             round(float(maxima[1, i]), 2),
+             identifier] for i, identifier in enumerate(identifiers)]
+
+
+def molecule_hash(mol):
+    # Content hash of a molecule, from its mol2 representation without the molecule name
+    lines = mol.to_string('mol2').splitlines()
+    if '@<TRIPOS>MOLECULE' in lines:
+        del lines[lines.index('@<TRIPOS>MOLECULE') + 1]
+    return hashlib.sha256('\n'.join(lines).encode()).hexdigest()
+
+
+def read_coformer_library(library):
+    # Reads the first molecule of every mol2 file in the coformer library
+    coformers = []
+    for f in sorted(glob.glob(os.path.join(library, '*.mol2'))):
+        with io.MoleculeReader(f) as reader:
+            coformers.append(reader[0])
+    return coformers
 
 
 def make_molecule_pair(api_molecule, coformer_molecule):
@@ -303,6 +451,35 @@ def pair_output(identifier, propensities, donors, acceptors, coordination_scores
     docx_template.save(output_file)
 
 
+def screen_rows(mc_hbp_screen):
+    # Flattens the ranked results into table rows, with the multi-component score components as columns
+    return [[rank, coformer_name, scores[5]] + scores[:5]
+            for rank, (coformer_name, scores) in enumerate(mc_hbp_screen, start=1)]
+
+
+def write_screen_output(mc_hbp_screen, directory, mol, parquet=False):
+    # Writes the ranked results as CSV and, if requested, as Parquet (failed pairs have no scores)
+    rows = screen_rows(mc_hbp_screen)
+    fname = os.path.join(directory, '%s_mc_hbp_screen' % mol.identifier)
+    with open('%s.csv' % fname, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(SCREEN_COLUMNS)
+        writer.writerows(rows)
+    print('Ranked results written to %s.csv' % fname)
+
+    if parquet:
+        try:
+            import pandas
+        except ImportError:
+            print('Error! pandas (with pyarrow) is needed to write Parquet files; run "%s -m pip install pandas '
+                  'pyarrow" to install it' % sys.executable)
+            return
+        table = pandas.DataFrame([[None if value == 'N/A' else value for value in row] for row in rows],
+                                 columns=SCREEN_COLUMNS)
+        table.to_parquet('%s.parquet' % fname, index=False)
+        print('Ranked results written to %s.parquet' % fname)
+
+
 def make_mc_report(identifier, results, directory, diagram_file, chart_file):
     # Write the MC-HBP report from the results
 
@@ -333,7 +510,34 @@ def make_mc_report(identifier, results, directory, diagram_file, chart_file):
     launch_word_processor(output_file)
 
 
-def main(structure, work_directory, failure_directory, library, csdrefcode, ignore_intra, force_run):
+def screen_pair(task):
+    # Runs the HBP calculation for one api/coformer pair; may run in a worker process, so each call has its own
+    # calculator and working directory, and a failure is returned rather than raised
+    pair_mol2, coformer_name, work_directory, pair_reports = task
+    print(coformer_name)
+    crystal = Crystal.from_string(pair_mol2, 'mol2')
+
+    directory = os.path.join(os.path.abspath(work_directory), crystal.identifier)
+    try:
+        store = None
+        if restore_fitting_data is not None:
+            store = FittingDataStore(os.path.join(work_directory, FITTING_DATA_DIRNAME))
+        hbp_calculator = PropensityCalc(store)
+        hbp_calculator.crystal = crystal
+        hbp_calculator.directory = directory
+        propensities, donors, acceptors = hbp_calculator.calculate()
+        coordination_scores = coordination_scores_calc(crystal, directory)
+        if pair_reports:
+            pair_output(crystal.identifier, propensities, donors, acceptors, coordination_scores, directory)
+        return coformer_name, propensity_records(propensities), None
+    except Exception as error_message:
+        print("Propensity calculation failure for %s!" % coformer_name)
+        error_string = f"{coformer_name}: {error_message}"
+        return coformer_name, None, error_string
+
+
+def main(structure, work_directory, failure_directory, library, csdrefcode, ignore_intra, force_run, processes=1,
+         cache_file=None, pair_reports=True, parquet=False):
     # This loads up the CSD if a refcode is requested, otherwise loads the structural file supplied
     if csdrefcode:
         try:
@@ -354,47 +558,73 @@ def main(structure, work_directory, failure_directory, library, csdrefcode, igno
         print('Error! Not all atoms in %s have sites!' % structure)
         quit()
 
-    # find the coformers and set up the calculations
-    coformer_files = glob.glob(os.path.join(library, '*.mol2'))
-    tempdir = tempfile.mkdtemp()
-    mc_dictionary = {}
+    # read the coformers and set up the calculations
+    coformers = read_coformer_library(library)
+    pair_records = {}
     failures = []
 
-    hbp_calculator = PropensityCalc()
+    # Results of pairs calculated before, in this or any other screen, are taken from the cache
+    cache = ResultCache(cache_file if cache_file else os.path.join(work_directory, RESULT_CACHE_FILENAME))
+    api_hash = molecule_hash(api_molecule)
+    cache_keys = {}
 
-    # for each coformer in the library, make a pair file for the api/coformer and run a HBP calculation
-    for f in coformer_files:
-        molecule_file, coformer_name = make_pair_file(api_molecule, tempdir, f)
-        print(coformer_name)
-        crystal_reader = io.CrystalReader(molecule_file)
-        crystal = crystal_reader[0]
+    # for each coformer in the library, make the api/coformer pair, then run the HBP calculations that are not
+    # cached, in parallel if more than one process is requested; pairs are passed to the calculations as mol2
+    # strings, so that no files are written and they can be sent to worker processes
+    tasks = []
+    for coformer_molecule in coformers:
+        coformer_name = coformer_molecule.identifier
+        cache_key, signature = cache.key(api_hash, molecule_hash(coformer_molecule))
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print('%s (cached)' % coformer_name)
+            pair_records[coformer_name] = cached
+            continue
+        cache_keys[coformer_name] = cache_key, signature
+        molecule_pair = make_molecule_pair(api_molecule, coformer_molecule)
+        tasks.append((molecule_pair.to_string('mol2'), coformer_name, work_directory, pair_reports))
+
+    if restore_fitting_data is None:
+        print('Warning! fitting_data.py from the Hydrogen Bond Propensity script was not found, so fitting data is '
+              'not shared between pairs')
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        pair_results = pool.imap_unordered(screen_pair, tasks)
+    else:
+        pool = None
+        pair_results = map(screen_pair, tasks)
 
-        directory = os.path.join(os.path.abspath(work_directory), crystal.identifier)
-        if os.path.exists(os.path.join(directory, "success.json")):
-            with open(os.path.join(directory, "success.json"), "r") as file:
-                tloaded = json.load(file)
-            mc_dictionary[coformer_name] = tloaded
+    for coformer_name, records, error_string in pair_results:
+        if error_string is not None:
+            warnings.warn(error_string)
+            failures.append(error_string)
         else:
-            try:
-                hbp_calculator.crystal = crystal
-                hbp_calculator.directory = directory
-                propensities, donors, acceptors = hbp_calculator.calculate()
-                coordination_scores = coordination_scores_calc(crystal, directory)
-                pair_output(crystal.identifier, propensities, donors, acceptors, coordination_scores, directory)
-                mc_dictionary[coformer_name] = get_mc_scores(propensities, crystal.identifier, ignore_intra)
-                with open(os.path.join(directory, "success.json"), "w") as file:
-                    json.dump(mc_dictionary[coformer_name], file)
-            except Exception as error_message:
-                print("Propensity calculation failure for %s!" % coformer_name)
-                error_string = f"{coformer_name}: {error_message}"
-                warnings.warn(error_string)
-                mc_dictionary[coformer_name] = ["N/A", "N/A", "N/A", "N/A", "N/A", crystal.identifier]
-                failures.append(error_string)
+            pair_records[coformer_name] = records
+            cache.put(*cache_keys[coformer_name], records)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    cache.close()
+
+    # Score all the successful pairs together from one table of their propensities; failed pairs have no scores
+    coformer_names = [coformer.identifier for coformer in coformers]
+    identifiers = ['%s--%s' % (api_molecule.identifier, name) for name in coformer_names]
+    scored = [i for i, name in enumerate(coformer_names) if name in pair_records]
+    table = propensity_table([pair_records[coformer_names[i]] for i in scored])
+    scores = get_mc_scores(table, [identifiers[i] for i in scored], ignore_intra)
+    mc_dictionary = {name: ["N/A", "N/A", "N/A", "N/A", "N/A", identifier]
+                     for name, identifier in zip(coformer_names, identifiers)}
+    for i, mc_scores in zip(scored, scores):
+        mc_dictionary[coformer_names[i]] = mc_scores
 
     # Make sense of the outputs of all the calculations
     mc_hbp_screen = sorted(mc_dictionary.items(), key=lambda e: 0 if e[1][0] == 'N/A' else e[1][0], reverse=True)
+    write_screen_output(mc_hbp_screen, work_directory, api_molecule, parquet)
+    mc_scores = np.array([value[0] for key, value in mc_hbp_screen if isinstance(value[0], float)])
     diagram_file = make_diagram(api_molecule, work_directory)
-    chart_file = make_mc_chart(mc_hbp_screen, work_directory, api_molecule)
+    chart_file = make_mc_chart(mc_scores, work_directory, api_molecule)
     make_mc_report(structure, mc_hbp_screen, work_directory, diagram_file, chart_file)
     if failure_directory is not None:
         with open(os.path.join(failure_directory, 'failures.txt'), 'w', encoding='utf-8', newline='') as file:
@@ -442,6 +672,15 @@ if __name__ == '__main__':
                         help='Ignore intramolecular hydrogen bonds when ranking pairs')
     parser.add_argument('--force_run_disordered', action="store_true",
                         help='Forces running the script on disordered entries. (NOT RECOMMENDED)', default=False)
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of co-formers to screen in parallel')
+    parser.add_argument('--cache_file', type=str, default=None,
+                        help='SQLite file of cached pair results, which may be shared between screens '
+                             '(default: %s in the working directory)' % RESULT_CACHE_FILENAME)
+    parser.add_argument('--no_pair_reports', action='store_true', default=False,
+                        help='Do not write a .docx report for each api/coformer pair')
+    parser.add_argument('--parquet', action='store_true', default=False,
+                        help='Also write the ranked results as a Parquet file (requires pandas and pyarrow)')
 
     args = parser.parse_args()
     refcode = False
@@ -457,4 +696,5 @@ if __name__ == '__main__':
         parser.error('%s - library not found.' % args.coformer_library)
 
     main(args.input_structure, args.directory, args.failure_directory, args.coformer_library, refcode,
-         args.ignore_intra, args.force_run_disordered)
+         args.ignore_intra, args.force_run_disordered, args.processes, args.cache_file, not args.no_pair_reports,
+         args.parquet)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# This script can be used for any purpose without limitation subject to the
+# conditions at https://www.ccdc.cam.ac.uk/Community/Pages/Licences/v2.aspx
+#
+# This permission notice and the following statement of attribution must be
+# included in all copies or substantial portions of this script.
+#
+
+import random
+import unittest
+from types import SimpleNamespace
+
+from multi_component_hydrogen_bond_propensity_report import (
+    get_mc_scores, label_component, propensity_records, propensity_table)
+
+
+def loop_mc_scores(propensities, identifier, ignore_intra):
+    """The multi-component scores of one pair, calculated by looping over its propensities as the script used to."""
+    AA, BB, AB, BA, intra = [], [], [], [], []
+    for p in propensities:
+        if ignore_intra and not p.is_intermolecular:
+            continue
+        t = "%s_d" % p.donor_label.split(" ")[0], "%s_a" % p.acceptor_label.split(" ")[0]
+        if '_A_' in t[0] and '_A_' in t[1]:
+            AA.append(p.propensity)
+            if not p.is_intermolecular:
+                intra.append(p.propensity)
+        elif '_B_' in t[0] and '_B_' in t[1]:
+            BB.append(p.propensity)
+            if not p.is_intermolecular:
+                intra.append(p.propensity)
+        elif '_A_' in t[0] and '_B_' in t[1]:
+            AB.append(p.propensity)
+        elif '_B_' in t[0] and '_A_' in t[1]:
+            BA.append(p.propensity)
+    max_list = [max(values) if values else 0.0 for values in (AA, BB, AB, BA)]
+    max_mc = max(max_list[2], max_list[3])
+    max_sc = max(max_list[0], max_list[1])
+    max_keys = ['A:A*', 'B:B*', 'A:B', 'B:A'] if max_sc in intra else ['A:A', 'B:B', 'A:B', 'B:A']
+    return [round(max_mc - max_sc, 2), max_keys[max_list.index(max(max_list))], round(max_mc, 2),
+            round(max_list[0], 2), round(max_list[1], 2), identifier]
+
+
+def random_propensities(rng, n):
+    """Random propensities between atoms of either component, or of neither; coarse values so that there are ties."""
+    def label():
+        return '%s%d%s' % (rng.choice('NO'), rng.randint(1, 9), rng.choice(['_A', '_B', '_A extra', '']))
+    return [SimpleNamespace(donor_label=label(), acceptor_label=label(), is_intermolecular=rng.random() < 0.5,
+                            propensity=rng.randint(0, 20) / 20.0) for _ in range(n)]
+
+
+class TestMCScores(unittest.TestCase):
+
+    def test_label_component(self):
+
+        self.assertEqual(label_component('O1_A'), 'A')
+        self.assertEqual(label_component('N12_B'), 'B')
+        self.assertEqual(label_component('O1_A other'), 'A')
+        self.assertEqual(label_component('O1'), '')
+
+    def test_matches_loop(self):
+
+        rng = random.Random(42)
+        for _ in range(50):
+            pairs = [random_propensities(rng, rng.randint(0, 12)) for _ in range(rng.randint(1, 8))]
+            identifiers = ['API--coformer%d' % i for i in range(len(pairs))]
+            table = propensity_table([propensity_records(propensities) for propensities in pairs])
+            for ignore_intra in (False, True):
+                self.assertEqual(get_mc_scores(table, identifiers, ignore_intra),
+                                 [loop_mc_scores(propensities, identifier, ignore_intra)
+                                  for propensities, identifier in zip(pairs, identifiers)])
+
+    def test_starred_intramolecular(self):
+
+        propensities = [SimpleNamespace(donor_label='O1_A', acceptor_label='O2_A', is_intermolecular=False,
+                                        propensity=0.8),
+                        SimpleNamespace(donor_label='O1_A', acceptor_label='N1_B', is_intermolecular=True,
+                                        propensity=0.5)]
+        table = propensity_table([propensity_records(propensities)])
+
+        self.assertEqual(get_mc_scores(table, ['pair'], False), [[-0.3, 'A:A*', 0.5, 0.8, 0.0, 'pair']])
+        self.assertEqual(get_mc_scores(table, ['pair'], True), [[0.5, 'A:B', 0.5, 0.0, 0.0, 'pair']])
+
+
+if __name__ == '__main__':
+    unittest.main()